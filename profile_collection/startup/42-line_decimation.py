@@ -0,0 +1,109 @@
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def minmax_decimate(x, y, max_points=4000):
+    '''Reduce a line to at most max_points vertices, keeping its shape
+
+    The points are split into max_points // 2 consecutive bins and the
+    minimum and maximum of each bin are kept, in their original order, so
+    peaks and edges look the same as with all the points. NaN points are
+    skipped, unless a whole bin is NaN (the gap of the line is kept).
+    Lines with max_points or fewer points are returned as they are.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= max_points:
+        return x, y
+    size = -(-n // max(max_points // 2 - 1, 1))
+    n_bins = -(-n // size)
+    binned = np.full(n_bins * size, np.nan)
+    binned[:n] = y
+    binned = binned.reshape(n_bins, size)
+    finite = np.isfinite(binned)
+    lo = np.argmin(np.where(finite, binned, np.inf), axis=1)
+    hi = np.argmax(np.where(finite, binned, -np.inf), axis=1)
+    offset = np.arange(n_bins) * size
+    index = np.unique(np.minimum(
+        np.concatenate([[0], offset + lo, offset + hi, [n - 1]]), n - 1))
+    return x[index], y[index]
+
+
+class DecimatedLine:
+    '''Keep the full data of a Line2D and draw it decimated
+
+    set_data(x, y) stores the data and gives the line the minmax_decimate
+    of it. When the x axis is zoomed (not autoscaled) and x is sorted, only
+    the visible part is decimated again, so zooming in shows all the
+    points of long scans. The xlim_changed callback is disconnected by
+    remove(), or at the next change of the limits once the line has been
+    removed from the axes.
+    '''
+    def __init__(self, line, max_points=4000):
+        self.line = line
+        self.max_points = max_points
+        self.x = self.y = np.zeros(0)
+        self._sorted = True
+        self._view = None
+        self._ax = line.axes
+        # a function (unlike a method) is kept alive by the axes
+        self._cid = self._ax.callbacks.connect(
+            'xlim_changed', lambda ax: self._xlim_changed(ax))
+
+    def disconnect(self):
+        '''Stop following the x limits of the axes'''
+        if self._cid is not None:
+            self._ax.callbacks.disconnect(self._cid)
+            self._cid = None
+
+    def remove(self):
+        '''Remove the line from its axes and disconnect it'''
+        self.disconnect()
+        if self.line.axes is not None:
+            self.line.remove()
+
+    def _xlim_changed(self, ax):
+        if self.line.axes is not ax:
+            self.disconnect()
+            return
+        self._decimate()
+
+    def set_data(self, x, y):
+        self.x = np.asarray(x)
+        self.y = np.asarray(y, dtype=np.float64)
+        self._sorted = len(self.x) < 2 or bool(np.all(np.diff(self.x) >= 0))
+        self._view = None
+        self._decimate()
+
+    def _decimate(self):
+        n = len(self.x)
+        start, stop = 0, n
+        ax = self.line.axes
+        if n > self.max_points and self._sorted and \
+                not ax.get_autoscalex_on():
+            lo, hi = sorted(ax.get_xlim())
+            # one point past each side, so the line reaches the edges
+            start = max(np.searchsorted(self.x, lo) - 1, 0)
+            stop = min(np.searchsorted(self.x, hi, side='right') + 1, n)
+        if self._view == (start, stop):
+            return
+        self._view = (start, stop)
+        self.line.set_data(*minmax_decimate(self.x[start:stop],
+                                            self.y[start:stop],
+                                            self.max_points))
+
+
+def plot_decimated(x, y, *args, ax=None, max_points=4000, **kwargs):
+    '''plt.plot of a single line, drawn with at most max_points vertices
+
+    Returns the Line2D; its DecimatedLine is line.decimated.
+    '''
+    if ax is None:
+        ax = plt.gca()
+    line, = ax.plot([], [], *args, **kwargs)
+    line.decimated = DecimatedLine(line, max_points)
+    line.decimated.set_data(x, y)
+    ax.relim()
+    ax.autoscale_view()
+    return line
@@ -6,7 +6,9 @@ from bluesky.callbacks.core import CallbackBase, LiveTable
 from bluesky.callbacks.mpl_plotting import LivePlot, LiveGrid, LiveScatter
 
 import matplotlib.pyplot as plt
+from matplotlib.backend_bases import TimerBase
 
+import time
 from itertools import count
 
 def hinted_fields(descriptor):
@@ -26,13 +28,144 @@ def hinted_fields(descriptor):
         columns.extend(fields)
     return columns
 
+class RenderScheduler:
+    '''Coalesce the redraws of live plots to a target frame rate
+
+    Live plots record their data on every event and call request(plot);
+    the artists are updated (plot._render()) and the canvases redrawn
+    from a timer on the GUI event loop, at most `fps` times per second.
+    Requests for a plot that is already waiting for a frame are counted
+    in `dropped`. Without a GUI event loop the pending plots are rendered
+    on the first request after 1 / fps seconds, and at the end of a scan.
+    '''
+    def __init__(self, fps=10.):
+        self.fps = fps
+        self._pending = {}
+        self._timer = None
+        self._timer_running = False
+        self._last_flush = 0.
+        self.requests = 0
+        self.frames = 0
+        self.dropped = 0
+
+    def request(self, plot):
+        self.requests += 1
+        if plot in self._pending:
+            self.dropped += 1
+        else:
+            self._pending[plot] = None
+        if self._timer is None:
+            # made once, from the first canvas; it is restarted per frame
+            self._timer = plot.ax.figure.canvas.new_timer(
+                interval=int(1000 / self.fps))
+            self._timer.single_shot = True
+            self._timer.add_callback(self.flush)
+        if type(self._timer) is TimerBase:
+            # non-interactive backend: no event loop to defer to
+            if time.monotonic() - self._last_flush >= 1. / self.fps:
+                self.flush()
+        elif not self._timer_running:
+            self._timer_running = True
+            self._timer.start()
+
+    def flush(self):
+        '''Render all pending plots now'''
+        if self._timer_running:
+            self._timer.stop()
+            self._timer_running = False
+        self._last_flush = time.monotonic()
+        pending = list(self._pending)
+        self._pending.clear()
+        figures = {}
+        for plot in pending:
+            plot._render()
+            figures[plot.ax.figure] = None
+        for fig in figures:
+            fig.canvas.draw_idle()
+        self.frames += len(figures)
+
+    def reset_counters(self):
+        self.requests = self.frames = self.dropped = 0
+
+
+if 'render_scheduler' not in globals():
+    render_scheduler = RenderScheduler()
+
+
+class LivePlotPlusPeaksHxn(LivePlotPlusPeaks):
+    '''LivePlotPlusPeaks redrawn through the render scheduler
+
+    The line of each run is drawn decimated (see DecimatedLine), so long
+    scans cost at most a few thousand vertices per frame. One instance
+    is made per run; FigureRegistry reuses the axes of the last run, not
+    the instance.
+    '''
+    scheduler = render_scheduler
+
+    def start(self, doc):
+        super().start(doc)
+        self.current_decimated = DecimatedLine(self.current_line)
+
+    def update_plot(self):
+        self.scheduler.request(self)
+
+    def _render(self):
+        self.current_decimated.set_data(self.x_data, self.y_data)
+        # Rescale
+        self.ax.relim(visible_only=True)
+        self.ax.autoscale_view(tight=True)
+
+
+class LiveGridHxn(LiveGrid):
+    '''LiveGrid redrawn through the render scheduler
+
+    Unlike LiveGrid, an instance can be reused for the next run: the image
+    and colorbar of the last run are replaced.
+    '''
+    scheduler = render_scheduler
+
+    def release(self):
+        '''Remove the image and colorbar of the last run from the axes'''
+        if self.im is not None:
+            if self.im.colorbar is not None:
+                self.im.colorbar.remove()
+            self.im.remove()
+            self.im = None
+
+    def start(self, doc):
+        self.release()
+        super().start(doc)
+
+    def update(self, pos, I):
+        self._Idata[pos] = I
+        self.scheduler.request(self)
+
+    def _render(self):
+        if self.clim is None:
+            self.im.set_clim(np.nanmin(self._Idata), np.nanmax(self._Idata))
+        self.im.set_array(self._Idata)
+
+
 class LiveScatterHxn(LiveScatter):
+    '''LiveScatter for long fermat/spiral scans
+
+    Points go into a preallocated (x, y, I) buffer that doubles when
+    full, and the limits are kept as running min/max, so an event costs
+    O(1). The scatter artist is updated through the render scheduler,
+    and once more at the end of the scan.
+    '''
+    scheduler = render_scheduler
 
     def start(self, doc):
-        self._xdata.clear()
-        self._ydata.clear()
-        self._Idata.clear()
-        sc = self.ax.scatter(self._xdata, self._ydata, 
+        if getattr(self, 'sc', None) is not None:
+            # reused for the next run on the same axes
+            self.sc.remove()
+            self._sc.remove(self.sc)
+        self._buffer = np.empty((1024, 3))
+        self._npts = 0
+        self._minx, self._maxx, self._miny, self._maxy = (None, ) * 4
+        self._minI = self._maxI = None
+        sc = self.ax.scatter(np.empty(0), np.empty(0),
                              norm=self._norm, cmap=self.cmap, **self.kwargs)
         self._sc.append(sc)
         self.sc = sc
@@ -44,39 +177,118 @@ class LiveScatterHxn(LiveScatter):
 
         # if one is None all are
         if self._minx is None:
-            self._minx = self.xlim[0]
-            self._maxx = self.xlim[1]
-            self._miny = self.ylim[0]
-            self._maxy = self.ylim[1]
-
-        self._xdata.append(x)
-        self._ydata.append(y)
-        self._Idata.append(I)
-        offsets = np.vstack([self._xdata, self._ydata]).T
-        self.sc.set_offsets(offsets)
-        self.sc.set_array(np.asarray(self._Idata))
+            self._minx, self._maxx = (x, x) if self.xlim is None else self.xlim
+            self._miny, self._maxy = (y, y) if self.ylim is None else self.ylim
 
-        # if self.xlim is None:
- 
-        minx, maxx = np.minimum(x, self._minx), np.maximum(x, self._maxx)
-        self.ax.set_xlim(minx, maxx)
+        if self._npts == len(self._buffer):
+            self._buffer = np.concatenate([self._buffer,
+                                           np.empty_like(self._buffer)])
+        self._buffer[self._npts] = x, y, I
+        self._npts += 1
 
-        self._minx = minx
-        self._maxx = maxx
+        # if self.xlim is None:
+        self._minx = min(x, self._minx)
+        self._maxx = max(x, self._maxx)
 
         # if self.ylim is None:
-        miny, maxy = np.minimum(y, self._miny), np.maximum(y, self._maxy)
-        self.ax.set_ylim(miny, maxy)
+        self._miny = min(y, self._miny)
+        self._maxy = max(y, self._maxy)
 
-        self._miny = miny
-        self._maxy = maxy     
-
-        if self.clim is None:
-            clim = np.nanmin(self._Idata), np.nanmax(self._Idata)
-            self.sc.set_clim(*clim)
+        if I == I:
+            if self._minI is None:
+                self._minI = self._maxI = I
+            else:
+                self._minI = min(I, self._minI)
+                self._maxI = max(I, self._maxI)
+
+        self.scheduler.request(self)
+
+    def _render(self):
+        '''Show the points received so far'''
+        data = self._buffer[:self._npts]
+        self.sc.set_offsets(data[:, :2])
+        self.sc.set_array(data[:, 2])
+        if self._minx is not None:
+            self.ax.set_xlim(self._minx, self._maxx)
+            self.ax.set_ylim(self._miny, self._maxy)
+        if self.clim is None and self._minI is not None:
+            self.sc.set_clim(self._minI, self._maxI)
+
+    def stop(self, doc):
+        self._render()
+        super().stop(doc)
+
+
+def _release_grid(plot, ax):
+    '''Clear a pooled LiveGridHxn off ax before a new plot replaces it
+
+    The new plot clears the axes (ax.cla()), which leaves the colorbar
+    of the old grid on the figure.
+    '''
+    if isinstance(plot, LiveGridHxn) and plot.ax is ax:
+        plot.release()
+
+
+class FigureRegistry:
+    '''Figures of the best effort callback, by (columns, dim_fields)
+
+    Finding the figure of a new scan is a dict lookup, instead of matching
+    every open figure label, and the axes and 2D live plots of a figure
+    are kept with it, so a scan drawn on the figure of the last one reuses
+    them as they are (1D scans get a new LivePlotPlusPeaksHxn on the same
+    axes). Entries of figures closed since are dropped when
+    they are looked up.
+    '''
+    def __init__(self):
+        self._entries = {}
+        self._next_number = {}
+
+    @staticmethod
+    def key(columns, dim_fields):
+        return tuple(sorted(columns)), tuple(sorted(dim_fields))
+
+    def get(self, key):
+        '''Entry of the open figure of key, or None'''
+        entry = self._entries.get(key)
+        if entry is not None:
+            number = getattr(entry['fig'], 'number', None)
+            if number is not None and not plt.fignum_exists(number):
+                del self._entries[key]
+                entry = None
+        return entry
+
+    def add(self, key, fig):
+        '''Register fig (with its axes) as the figure of key'''
+        entry = {'fig': fig, 'axes': list(fig.axes), 'plots': {},
+                 'run': None}
+        self._entries[key] = entry
+        return entry
+
+    def unique_label(self, label):
+        '''label, or 'label N' with the first N not in use'''
+        if not plt.fignum_exists(label):
+            return label
+        number = self._next_number.get(label, 2)
+        while plt.fignum_exists('{} {}'.format(label, number)):
+            number += 1
+        self._next_number[label] = number + 1
+        return '{} {}'.format(label, number)
 
 
 class BestEffortCallbackHxn(BestEffortCallback):
+       scheduler = render_scheduler
+       # reuse the figure (and LiveGrid/LiveScatter) of the last 2D scan
+       # of the same fields instead of opening a new one
+       reuse_2d_figures = False
+
+       def __init__(self, *args, **kwargs):
+           super().__init__(*args, **kwargs)
+           self.figures = FigureRegistry()
+
+       def stop(self, doc):
+           # draw the last points before the peaks are annotated
+           self.scheduler.flush()
+           super().stop(doc)
 
        def descriptor(self, doc):
            
@@ -143,55 +355,49 @@ class BestEffortCallbackHxn(BestEffortCallback):
         else:
             dim_fields = ['time']  # 'time' once LivePlot can do that
 
-        # Create a figure or reuse an existing one.
-
-        fig_name = '{} vs {}'.format(' '.join(sorted(columns)),
-                                     ' '.join(sorted(dim_fields)))
-        if self.overplot and len(dim_fields) == 1:
-            # If any open figure matches 'figname {number}', use it. If there
-            # are multiple, the most recently touched one will be used.
-            pat1 = re.compile('^' + fig_name + '$')
-            pat2 = re.compile('^' + fig_name + r' \d+$')
-            for label in plt.get_figlabels():
-                if pat1.match(label) or pat2.match(label):
-                    fig_name = label
-                    break
-        else:
-            if plt.fignum_exists(fig_name):
-                # Generate a unique name by appending a number.
-                for number in itertools.count(2):
-                    new_name = '{} {}'.format(fig_name, number)
-                    if not plt.fignum_exists(new_name):
-                        fig_name = new_name
-                        break
         ndims = len(dim_fields)
         if not 0 < ndims < 3:
             # we need 1 or 2 dims to do anything, do not make empty figures
             return
 
-        if self._fig_factory:
-            fig = self._fig_factory(fig_name)
-        else:
-            fig = plt.figure(fig_name)
-        if not fig.axes:
-            # This is apparently a fresh figure. Make axes.
-            # The complexity here is due to making a shared x axis. This can be
-            # simplified when Figure supports the `subplots` method in a future
-            # release of matplotlib.
-            fig.set_size_inches(6.4, min(950, len(columns) * 400) / fig.dpi)
-            for i in range(len(columns)):
-                if i == 0:
-                    ax = fig.add_subplot(len(columns), 1, 1 + i)
-                    if ndims == 1:
-                        share_kwargs = {'sharex': ax}
-                    elif ndims == 2:
-                        share_kwargs = {'sharex': ax, 'sharey': ax}
-                    else:
-                        raise NotImplementedError("we now support 3D?!")
+        # Create a figure or reuse an existing one.
+
+        key = self.figures.key(columns, dim_fields)
+        reuse = (self.overplot and ndims == 1) or \
+            (self.reuse_2d_figures and ndims == 2)
+        entry = self.figures.get(key) if reuse else None
+        if entry is None:
+            fig_name = '{} vs {}'.format(' '.join(key[0]), ' '.join(key[1]))
+            if not reuse:
+                fig_name = self.figures.unique_label(fig_name)
+            if self._fig_factory:
+                fig = self._fig_factory(fig_name)
+            else:
+                fig = plt.figure(fig_name)
+            if not fig.axes:
+                # This is apparently a fresh figure. Make axes.
+                fig.set_size_inches(6.4,
+                                    min(950, len(columns) * 400) / fig.dpi)
+                ax = fig.add_subplot(len(columns), 1, 1)
+                if ndims == 1:
+                    share_kwargs = {'sharex': ax}
                 else:
-                    ax = fig.add_subplot(len(columns), 1, 1 + i,
-                                         **share_kwargs)
-        axes = fig.axes
+                    share_kwargs = {'sharex': ax, 'sharey': ax}
+                for i in range(1, len(columns)):
+                    fig.add_subplot(len(columns), 1, 1 + i, **share_kwargs)
+            entry = self.figures.add(key, fig)
+            new_figure = True
+        else:
+            fig = entry['fig']
+            new_figure = False
+        axes = entry['axes']
+        # live plots are reused from the last run drawn on these axes, but
+        # never twice in the same run
+        uid = self._start_doc['uid']
+        if entry['run'] == uid:
+            entry['plots'] = {}
+        entry['run'] = uid
+        pool = entry['plots']
 
         # ## LIVE PLOT AND PEAK ANALYSIS ## #
 
@@ -206,8 +412,8 @@ class BestEffortCallbackHxn(BestEffortCallback):
                          "".format(y_key, dtype))
                     continue
                 # Create an instance of LivePlot and an instance of PeakStats.
-                live_plot = LivePlotPlusPeaks(y=y_key, x=x_key, ax=ax,
-                                              peak_results=self.peaks)
+                live_plot = LivePlotPlusPeaksHxn(y=y_key, x=x_key, ax=ax,
+                                                 peak_results=self.peaks)
                 live_plot('start', self._start_doc)
                 live_plot('descriptor', doc)
                 peak_stats = PeakStats(x=x_key, y=y_key)
@@ -251,11 +457,20 @@ class BestEffortCallbackHxn(BestEffortCallback):
                             aspect = 'auto'
                             ax.set_aspect(aspect, adjustable='datalim')
 
-                        live_grid = LiveGrid(shape, I_key,
-                                             xlabel=fast, ylabel=slow,
-                                             extent=adjusted_extent,
-                                             aspect=aspect,
-                                             ax=ax)
+                        live_grid = pool.get(I_key)
+                        if isinstance(live_grid, LiveGridHxn) and \
+                                live_grid.ax is ax and \
+                                live_grid.raster_shape == shape:
+                            live_grid.extent = adjusted_extent
+                            live_grid.aspect = aspect
+                        else:
+                            _release_grid(live_grid, ax)
+                            live_grid = LiveGridHxn(shape, I_key,
+                                                 xlabel=fast, ylabel=slow,
+                                                 extent=adjusted_extent,
+                                                 aspect=aspect,
+                                                 ax=ax)
+                            entry['plots'][I_key] = live_grid
 
                         live_grid('start', self._start_doc)
                         live_grid('descriptor', doc)
@@ -270,21 +485,29 @@ class BestEffortCallbackHxn(BestEffortCallback):
                         xlim = ylim = None
                     else:
                         xlim, ylim = extents
-                    live_scatter = LiveScatterHxn(x_key, y_key, I_key,
-                                               xlim=xlim, ylim=ylim,
-                                               # Let clim autoscale.
-                                               ax=ax)
-                     
+                    live_scatter = pool.get(I_key)
+                    if isinstance(live_scatter, LiveScatterHxn) and \
+                            live_scatter.ax is ax:
+                        live_scatter.xlim, live_scatter.ylim = xlim, ylim
+                    else:
+                        _release_grid(live_scatter, ax)
+                        live_scatter = LiveScatterHxn(x_key, y_key, I_key,
+                                                   xlim=xlim, ylim=ylim,
+                                                   # Let clim autoscale.
+                                                   ax=ax)
+                        entry['plots'][I_key] = live_scatter
+
                     live_scatter('start', self._start_doc)
                     live_scatter('descriptor', doc)
                     self._live_scatters[doc['uid']][I_key] = live_scatter
         else:
             raise NotImplementedError("we do not support 3D+ in BEC yet "
                                       "(and it should have bailed above)")
-        try:
-            fig.tight_layout()
-        except ValueError:
-            pass
+        if new_figure:
+            try:
+                fig.tight_layout()
+            except ValueError:
+                pass
 
 
 bec_hxn = BestEffortCallbackHxn()
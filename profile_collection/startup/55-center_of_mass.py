@@ -0,0 +1,125 @@
+import time
+
+import numpy as np
+
+
+def _threshold(w, threshold, bitmask, axes=None):
+    '''Threshold center of mass weights in place
+
+    Values below threshold * max (over `axes`) are set to 0. With
+    `bitmask`, values above threshold * max are set to 1 and the others
+    to 0, as the bitflag of the mov_to_image_* plans does.
+    '''
+    vmax = np.max(w, axis=axes, keepdims=axes is not None)
+    if bitmask:
+        return (w > threshold * vmax).astype(np.float64)
+    w[w < threshold * vmax] = 0.
+    return w
+
+
+def com_1d(values, x=None, threshold=None, bitmask=False, axis=-1):
+    '''Center of mass of one or many profiles
+
+    Parameters
+    ----------
+    values : array_like
+        A profile, or profiles along `axis`
+    x : array_like, optional
+        Coordinates of the points (broadcast against `values`); the
+        result is in index units without it
+    threshold : float, optional
+        Ignore values below threshold * max of each profile
+    bitmask : bool, optional
+        With `threshold`, weigh the remaining points equally
+
+    Returns
+    -------
+    com : float or ndarray
+        NaN for profiles that sum to 0
+    '''
+    w = np.moveaxis(np.array(values, dtype=np.float64), axis, -1)
+    if threshold is not None:
+        axes = (-1, ) if w.ndim > 1 else None
+        w = _threshold(w, threshold, bitmask, axes)
+    if x is None:
+        x = np.arange(w.shape[-1], dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+
+    total = w.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if x.ndim == 1:
+            return (w @ x) / total
+        return np.sum(w * np.moveaxis(x, axis, -1), axis=-1) / total
+
+
+def com_2d(image, threshold=None, bitmask=False):
+    '''Center of mass (row, column) of an image, in pixels
+
+    Same result as scipy.ndimage.center_of_mass, computed from the two
+    projections of the image; a stack of images gives arrays. `threshold`
+    and `bitmask` are as in com_1d, relative to the maximum of each image.
+    '''
+    w = np.array(image, dtype=np.float64)
+    if w.ndim == 2:
+        w = w[np.newaxis]
+    if threshold is not None:
+        w = _threshold(w, threshold, bitmask, axes=(1, 2))
+    rows = w.sum(axis=2)
+    cols = w.sum(axis=1)
+    total = rows.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row = rows @ np.arange(rows.shape[1], dtype=np.float64) / total
+        col = cols @ np.arange(cols.shape[1], dtype=np.float64) / total
+    if np.ndim(image) == 2:
+        return row[0], col[0]
+    return row, col
+
+
+def com_weighted(weights, *coords, threshold=None, bitmask=False):
+    '''Center of mass of scattered points in their own coordinates
+
+    E.g. com_weighted(xrf, x, y) gives the (x, y) motor position of the
+    center of mass of a map, whatever its scan pattern.
+    '''
+    w = np.ravel(weights).astype(np.float64)
+    if threshold is not None:
+        w = _threshold(w, threshold, bitmask)
+    total = w.sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        com = tuple(w @ np.ravel(c).astype(np.float64) / total
+                    for c in coords)
+    return com[0] if len(com) == 1 else com
+
+
+def _best_of(func, repeat=3):
+    '''(shortest time of `repeat` calls of func(), its result), for the
+    benchmark_* helpers'''
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        res = func()
+        times.append(time.perf_counter() - t0)
+    return min(times), res
+
+
+def _com_1d_loop(array, x=None):
+    '''The original pure Python center of mass, kept for the benchmark'''
+    n = np.size(array)
+    tmp = 0
+    for i in range(n):
+        tmp += (i if x is None else x[i]) * array[i]
+    return tmp / np.sum(array)
+
+
+def benchmark_center_of_mass(points=100000, repeat=3):
+    '''Time com_1d against the pure Python loop it replaces'''
+    rng = np.random.RandomState(0)
+    x = np.linspace(-50., 50., points)
+    profile = np.exp(-(x - 3.) ** 2 / 50.) + rng.uniform(0, 0.01, points)
+
+    t_loop, loop_res = _best_of(lambda: _com_1d_loop(profile, x), repeat)
+    t_vec, vec_res = _best_of(lambda: com_1d(profile, x), repeat)
+    print('{} points: loop {:.4f} s, vectorized {:.6f} s, speedup {:.0f}x, '
+          'difference {:.3g}'.format(points, t_loop, t_vec, t_loop / t_vec,
+                                     abs(loop_res - vec_res)))
+    return t_loop, t_vec
@@ -0,0 +1,278 @@
+import numpy as np
+from scipy.special import erf
+
+
+_SQRT2 = np.sqrt(2.0)
+_ERF_SLOPE = 2.0 / np.sqrt(np.pi)
+
+
+def _erf_terms(z, a, b):
+    '''erf((z-a)/(b*sqrt(2))) and its derivatives with respect to a and b'''
+    u = (z - a) / (b * _SQRT2)
+    g = _ERF_SLOPE * np.exp(-u * u)
+    return erf(u), -g / (b * _SQRT2), -g * u / b
+
+
+def _erf_edge(z, p, sign, linear):
+    '''erfunc1..4 and their Jacobian; p is (m, 3) or (m, 5)'''
+    a, b, c = (p[:, i, None] for i in range(3))
+    e, de_da, de_db = _erf_terms(z, a, b)
+    jac = np.empty(e.shape + (p.shape[1], ))
+    step = jac[..., 2]
+    np.add(1.0, sign * e, out=step)
+    f = c * step
+    np.multiply(sign * c, de_da, out=jac[..., 0])
+    np.multiply(sign * c, de_db, out=jac[..., 1])
+    if linear:
+        f += p[:, 3, None] + p[:, 4, None] * z
+        jac[..., 3] = 1.0
+        jac[..., 4] = z
+    return f, jac
+
+
+def _square(z, p):
+    '''squarefunc and its Jacobian; p is (m, 5)'''
+    c, a1, b1, a2, b2 = (p[:, i, None] for i in range(5))
+    e1, de1_da, de1_db = _erf_terms(z, a1, b1)
+    e2, de2_da, de2_db = _erf_terms(z, a2, b2)
+    jac = np.empty(e1.shape + (5, ))
+    np.subtract(e1, e2, out=jac[..., 0])
+    f = c * jac[..., 0]
+    np.multiply(c, de1_da, out=jac[..., 1])
+    np.multiply(c, de1_db, out=jac[..., 2])
+    np.multiply(-c, de2_da, out=jac[..., 3])
+    np.multiply(-c, de2_db, out=jac[..., 4])
+    return f, jac
+
+
+# Models of fit_edges, named after the functions of 90-alignment, as
+# name: (function and Jacobian, number of parameters)
+EDGE_MODELS = {
+    'erfunc1': (lambda z, p: _erf_edge(z, p, 1.0, False), 3),
+    'erfunc2': (lambda z, p: _erf_edge(z, p, -1.0, False), 3),
+    'erfunc3': (lambda z, p: _erf_edge(z, p, 1.0, True), 5),
+    'erfunc4': (lambda z, p: _erf_edge(z, p, -1.0, True), 5),
+    'squarefunc': (_square, 5),
+}
+
+
+def fit_edges(x, y, model, p0, max_iter=100, tol=1.5e-8):
+    '''Least-squares fit of many profiles at once
+
+    Levenberg-Marquardt with the analytic Jacobian of the model; all the
+    profiles are updated together, each with its own damping.
+
+    Parameters
+    ----------
+    x : (n, ) or (m, n) array_like
+        Positions, shared by all profiles or one row per profile
+    y : (n, ) or (m, n) array_like
+        Profiles
+    model : str
+        One of EDGE_MODELS
+    p0 : (p, ) or (m, p) array_like
+        Initial parameters, in the order of the model function
+    max_iter : int, optional
+    tol : float, optional
+        A fit stops when its relative decrease of the residual sum of
+        squares falls below tol
+
+    Returns
+    -------
+    params : (p, ) or (m, p) ndarray
+        Shaped like p0, or (m, p) when there are several profiles
+    chi2 : float or (m, ) ndarray
+        Residual sum of squares
+    '''
+    func, n_params = EDGE_MODELS[model]
+    y = np.asarray(y, dtype=np.float64)
+    single = y.ndim == 1 and np.ndim(p0) == 1
+    y = np.atleast_2d(y)
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    p = np.array(np.broadcast_to(p0, (len(y), n_params)), dtype=np.float64)
+
+    if len(y) == 1:
+        p[0], cost = _fit_one(func, x, y, p, max_iter, tol)
+        return (p[0], cost) if single else (p, np.array([cost]))
+
+    f, jac = func(x, p)
+    res = y - f
+    cost = np.einsum('mn,mn->m', res, res)
+    lam = np.full(len(y), 1e-3)
+    active = np.ones(len(y), dtype=bool)
+    eye = np.eye(n_params)
+
+    for i in range(max_iter):
+        idx = np.flatnonzero(active)
+        if not len(idx):
+            break
+        j = jac[idx]
+        jtj = np.einsum('mnp,mnq->mpq', j, j)
+        jtr = np.einsum('mnp,mn->mp', j, res[idx])
+        damp = lam[idx, None, None] * jtj * eye
+        try:
+            step = np.linalg.solve(jtj + damp + 1e-30 * eye,
+                                   jtr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.array([np.linalg.lstsq(a + d, r, rcond=None)[0]
+                             for a, d, r in zip(jtj, damp, jtr)])
+
+        trial = p[idx] + step
+        f_new, jac_new = func(x[idx] if len(x) > 1 else x, trial)
+        res_new = y[idx] - f_new
+        cost_new = np.einsum('mn,mn->m', res_new, res_new)
+
+        better = cost_new < cost[idx]
+        good = idx[better]
+        converged = np.zeros(len(idx), dtype=bool)
+        converged[better] = (cost[good] - cost_new[better] <=
+                             tol * np.maximum(cost[good], 1e-300))
+        p[good] = trial[better]
+        res[good] = res_new[better]
+        jac[good] = jac_new[better]
+        cost[good] = cost_new[better]
+        lam[good] /= 10.
+        lam[idx[~better]] *= 10.
+        converged |= ~better & (lam[idx] > 1e10)
+        active[idx[converged]] = False
+
+    if single:
+        return p[0], cost[0]
+    return p, cost
+
+
+def _fit_one(func, x, y, p, max_iter, tol):
+    '''fit_edges of a single profile, without the batch bookkeeping'''
+    f, jac = func(x, p)
+    res = (y - f)[0]
+    jac = jac[0]
+    cost = res @ res
+    lam = 1e-3
+    for i in range(max_iter):
+        jtj = jac.T @ jac
+        diag = np.diag(jtj)
+        try:
+            step = np.linalg.solve(jtj + np.diag(lam * diag + 1e-30),
+                                   jac.T @ res)
+        except np.linalg.LinAlgError:
+            step = np.linalg.lstsq(jtj, jac.T @ res, rcond=None)[0]
+        trial = p + step
+        f, jac_new = func(x, trial)
+        res_new = (y - f)[0]
+        cost_new = res_new @ res_new
+        if cost_new < cost:
+            done = cost - cost_new <= tol * max(cost, 1e-300)
+            p, res, jac, cost = trial, res_new, jac_new[0], cost_new
+            lam /= 10.
+            if done:
+                break
+        else:
+            lam *= 10.
+            if lam > 1e10:
+                break
+    return p[0], cost
+
+
+def fit_edge(x, y, model, p0, **kwargs):
+    '''fit_edges for a single profile; returns the parameters only'''
+    return fit_edges(x, y, model, p0, **kwargs)[0]
+
+
+def find_edges(x, y, size=10, set_point=0.5):
+    '''Position where the moving average of each profile crosses set_point
+
+    The initial guess of the edge fits. y is (n, ) or (m, n), and x is
+    shared or one row per profile; the averages are computed with a
+    cumulative sum, for all profiles at once.
+    '''
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x)
+    csum = np.cumsum(y, axis=-1)
+    csum = np.concatenate([np.zeros(y.shape[:-1] + (1, )), csum], axis=-1)
+    n_windows = y.shape[-1] - size
+    local_mean = (csum[..., size:size + n_windows] -
+                  csum[..., :n_windows]) / size
+    index = (np.argmin(np.abs(local_mean - set_point), axis=-1) +
+             int(np.ceil(size / 2.0)))
+    if x.ndim == 1:
+        return x[index]
+    return np.take_along_axis(np.broadcast_to(x, y.shape),
+                              np.atleast_1d(index)[:, None], axis=-1)[:, 0]
+
+
+def erf_model(y, linear_flag=True):
+    '''Name of the erfunc model of each profile: rising or falling edge'''
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    half_size = y.shape[1] // 2
+    rising = y[:, :half_size].mean(axis=1) < y.mean(axis=1)
+    names = (np.where(rising, 'erfunc3', 'erfunc4') if linear_flag else
+             np.where(rising, 'erfunc1', 'erfunc2'))
+    return list(names)
+
+
+def normalize_profiles(y):
+    '''Scale profiles as the edge fits expect, (y - min) / max'''
+    y = np.asarray(y, dtype=np.float64)
+    return ((y - y.min(axis=-1, keepdims=True)) /
+            y.max(axis=-1, keepdims=True))
+
+
+def fit_erf_edges(x, y, linear_flag=True, size=10):
+    '''Edge position and FWHM (nm) of many normalized profiles at once
+
+    The model (rising or falling, with or without a linear background)
+    and the edge position used as the initial guess are found for each
+    profile as erf_fit did, then all the fits are run together.
+
+    Returns
+    -------
+    params : (m, p) ndarray
+    models : list of str
+    '''
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    x = np.asarray(x, dtype=np.float64)
+    models = erf_model(y, linear_flag)
+    edges = np.atleast_1d(find_edges(x, y, size))
+    n_params = 5 if linear_flag else 3
+    p0 = np.zeros((len(y), n_params))
+    p0[:, 0] = edges
+    p0[:, 1] = 0.05
+    p0[:, 2] = 0.5
+
+    params = np.empty_like(p0)
+    for name in set(models):
+        rows = np.array([m == name for m in models])
+        params[rows] = fit_edges(x if x.ndim == 1 else x[rows], y[rows],
+                                 name, p0[rows])[0]
+    return params, models
+
+
+def benchmark_edge_fit(points=100, profiles=200, repeat=3):
+    '''Time fit_edges against scipy.optimize.curve_fit on erfunc3'''
+    from scipy.optimize import curve_fit
+
+    def erfunc3(z, a, b, c, d, e):
+        return d + e * z + c * (erf((z - a) / (b * _SQRT2)) + 1.0)
+
+    rng = np.random.RandomState(0)
+    x = np.linspace(-1, 1, points)
+    edges = rng.uniform(-0.3, 0.3, profiles)
+    y = np.array([erfunc3(x, a, 0.04, 0.5, 0.01, 0.02) for a in edges])
+    y += rng.normal(0, 0.01, y.shape)
+    p0 = np.column_stack([find_edges(x, y), np.full(profiles, 0.05),
+                          np.full(profiles, 0.5), np.zeros(profiles),
+                          np.zeros(profiles)])
+
+    t_curve, curve_res = _best_of(lambda: np.array(
+        [curve_fit(erfunc3, x, yi, p0=pi)[0] for yi, pi in zip(y, p0)]),
+        repeat)
+    t_single, single_res = _best_of(lambda: np.array(
+        [fit_edge(x, yi, 'erfunc3', pi) for yi, pi in zip(y, p0)]), repeat)
+    t_batch, (batch_res, chi2) = _best_of(
+        lambda: fit_edges(x, y, 'erfunc3', p0), repeat)
+    print('{} fits of {} points: curve_fit {:.1f} ms/fit, fit_edge {:.3f} '
+          'ms/fit, batched {:.3f} ms/fit, largest edge difference {:.2g}'
+          ''.format(profiles, points, 1e3 * t_curve / profiles,
+                    1e3 * t_single / profiles, 1e3 * t_batch / profiles,
+                    np.max(np.abs(batch_res[:, 0] - curve_res[:, 0]))))
+    return t_curve, t_single, t_batch
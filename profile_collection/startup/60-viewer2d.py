@@ -2,6 +2,7 @@ import functools
 import os
 import sys
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import h5py
 import matplotlib.pyplot as plt
@@ -120,9 +121,16 @@ def scatter_plot(scan_id, namex, namey, elem='Pt', channels=None, norm=None):
     plt.show()
 
 
+# Lines of plot, plotfly and plot_all: the default line color with blue
+# markers, drawn as one line (they used to be a line plus a 'bo' series)
+_scan_line_style = dict(marker='o', markerfacecolor='b', markeredgecolor='b')
+
+
 # TODO turn into a callback
 def plot(scan_id, elem='Pt', norm=None,
-         center_method='com', log=0, e_flag=0):
+         center_method='com', log=0, e_flag=0, render=None):
+    if not _render(render):
+        return
     figure_with_insert_fig_button()
     scan_id, df = _load_scan(scan_id, fill_events=False)
     hdr = db[scan_id]['start']
@@ -160,11 +168,10 @@ def plot(scan_id, elem='Pt', norm=None,
     if norm is not None:
         norm_v = df[norm]
         if log:
-            plt.plot(x, np.log10(data / (norm_v+1.e-8)))
-            plt.plot(x, np.log10(data / (norm_v + 1.e-8)), 'bo')
+            plot_decimated(x, np.log10(data / (norm_v + 1.e-8)),
+                           **_scan_line_style)
         else:
-            plt.plot(x, data / (norm_v + 1.e-8))
-            plt.plot(x, data / (norm_v + 1.e-8), 'bo')
+            plot_decimated(x, data / (norm_v + 1.e-8), **_scan_line_style)
         if e_flag:
             plt.xlabel('Energy (keV)')
         else:
@@ -173,11 +180,9 @@ def plot(scan_id, elem='Pt', norm=None,
         plt.title('Scan %d' % (scan_id))
     else:
         if log:
-            plt.plot(x, np.log10(data+1.e-8))
-            plt.plot(x, np.log10(data+1.e-8), 'bo')
+            plot_decimated(x, np.log10(data + 1.e-8), **_scan_line_style)
         else:
-            plt.plot(x, data)
-            plt.plot(x, data, 'bo')
+            plot_decimated(x, data, **_scan_line_style)
         if e_flag:
             plt.xlabel('Energy (keV)')
         else:
@@ -187,8 +192,7 @@ def plot(scan_id, elem='Pt', norm=None,
         try:
             diff = np.diff(data)
             figure_with_insert_fig_button()
-            plt.plot(x[:-1], diff)
-            plt.plot(x[:-1], diff, 'bo')
+            plot_decimated(x[:-1], diff, **_scan_line_style)
         except Exception as ex:
             print('Failed to plot derivative: ({}) {}'
                   ''.format(ex.__class__.__name__, ex))
@@ -232,8 +236,7 @@ def plot_all(scan_id, namex=None, diff=False, channels=None,
         data = np.sum(df['Det%d_%s' % (chan, elem)]
                       for chan in channels)
 
-        ax.plot(x, data, label=elem)
-        ax.plot(x, data, 'bo')
+        plot_decimated(x, data, ax=ax, label=elem, **_scan_line_style)
 
     if same_axis:
         plt.legend(loc='best')
@@ -242,15 +245,14 @@ def plot_all(scan_id, namex=None, diff=False, channels=None,
 
 
 def find_mass_center(array):
-    n = np.size(array)
-    tmp = 0
-    for i in range(n):
-        tmp += i * array[i]
-    mc = np.round(tmp / np.sum(array))
+    mc = np.round(com_1d(array))
     return mc
 
 
-def plotfly(scan_id, elem='Pt', norm=None, center_method='com'):
+def plotfly(scan_id, elem='Pt', norm=None, center_method='com',
+            render=None):
+    if not _render(render):
+        return
     figure_with_insert_fig_button()
     scan_id, df = _load_scan(scan_id, fill_events=False)
     hdr = db[scan_id]['start']
@@ -275,8 +277,7 @@ def plotfly(scan_id, elem='Pt', norm=None, center_method='com'):
     try:
         diff = np.diff(roi_data)
         plt.subplot(122)
-        plt.plot(x[1:], diff)
-        plt.plot(x[1:], diff, 'bo')
+        plot_decimated(x[1:], diff, **_scan_line_style)
         #if center_method == 'com':
         #    i_center = find_mass_center(roi_data)
         #else:
@@ -293,8 +294,7 @@ def plotfly(scan_id, elem='Pt', norm=None, center_method='com'):
     else:
         plt.subplot(121)
 
-    plt.plot(x, roi_data)
-    plt.plot(x, roi_data, 'bo')
+    plot_decimated(x, roi_data, **_scan_line_style)
     plt.xlabel(scanned_axis)
     plt.ylabel(elem)
     plt.title(
@@ -376,13 +376,27 @@ def interp2d_scan(hdr, x_data, y_data, spectrum, *, kind='linear',
 
 
 def interp1d_scan(hdr, x_data, y_data, spectrum, kind='linear',
-                  plot_points=False, **kwargs):
-    '''Interpolate a 2D flyscan only over the fast-scanning direction'''
+                  plot_points=False, batch=True, **kwargs):
+    '''Interpolate a 2D flyscan only over the fast-scanning direction
+
+    With `batch` (the default), 'linear' and 'cubic' interpolation resample
+    all rows at once (see `interp1d_rows`). Any other `kind`, or extra
+    keyword arguments for scipy's interp1d, fall back to the row-by-row loop.
+    '''
     grid_x, grid_y = fly2d_grid(hdr, x_data, y_data, plot=plot_points)
-    x_data = fly2d_reshape(hdr, x_data, verbose=False)
+    x_data = fly2d_view(hdr, x_data, fill_value=np.nan, verbose=False)
+
+    if batch and kind in ('linear', 'cubic') and not kwargs:
+        spectrum2 = interp1d_rows(x_data, spectrum, grid_x, kind=kind)
+        return spectrum2.astype(np.asarray(spectrum).dtype, copy=False)
+
+    return _interp1d_rows_loop(x_data, spectrum, grid_x, kind=kind, **kwargs)
+
 
+def _interp1d_rows_loop(x_data, spectrum, grid_x, kind='linear', **kwargs):
+    '''Resample each row with its own scipy interp1d (the original method)'''
     spectrum2 = np.zeros_like(spectrum)
-    for row in range(len(grid_y)):
+    for row in range(spectrum.shape[0]):
         spectrum2[row, :] = interp1d(x_data[row, :], spectrum[row, :],
                                      kind=kind, bounds_error=False,
                                      **kwargs)(grid_x)
@@ -390,34 +404,333 @@ def interp1d_scan(hdr, x_data, y_data, spectrum, kind='linear',
     return spectrum2
 
 
+def interp1d_rows(x_data, spectrum, grid_x, kind='linear'):
+    '''Resample every row of a 2D flyscan onto `grid_x` in one pass
+
+    Parameters
+    ----------
+    x_data : ndarray
+        (rows, points) positions of the fast axis, e.g. the readback of a
+        reshaped flyscan. Rows do not need to be sorted, so pyramid scans
+        work whether or not their odd rows were flipped.
+    spectrum : ndarray
+        (rows, points) values measured at `x_data`
+    grid_x : ndarray
+        The positions to resample every row onto
+    kind : {'linear', 'cubic'}, optional
+        'cubic' uses a local cubic Hermite (Catmull-Rom style) interpolant
+        with finite-difference slopes, not scipy's global cubic spline
+
+    Returns
+    -------
+    spectrum2 : ndarray
+        (rows, len(grid_x)) array. Points outside of a row's measured range,
+        and rows with fewer than 2 finite points, are NaN (as with
+        ``interp1d(..., bounds_error=False)``). Non-finite readbacks or
+        values are ignored.
+    '''
+    if kind not in ('linear', 'cubic'):
+        raise ValueError('Unsupported interpolation kind: {}'.format(kind))
+
+    x_data = np.asarray(x_data, dtype=float)
+    spectrum = np.asarray(spectrum, dtype=float)
+    grid_x = np.asarray(grid_x, dtype=float)
+    rows, npts = x_data.shape
+    ngrid = len(grid_x)
+
+    # Sort each row by position, pushing invalid points to the end. The
+    # readbacks of a clean scan are usually already monotonic.
+    bad = ~(np.isfinite(x_data) & np.isfinite(spectrum))
+    if not bad.any() and np.all(np.diff(x_data, axis=1) >= 0):
+        xs, ys = x_data, spectrum
+    else:
+        xs = np.where(bad, np.nan, x_data)
+        order = np.argsort(xs, axis=1, kind='stable')
+        xs = np.take_along_axis(xs, order, axis=1)
+        ys = np.take_along_axis(spectrum, order, axis=1)
+    n_valid = npts - bad.sum(axis=1)
+
+    good_rows = n_valid >= 2
+    if not np.any(good_rows):
+        return np.full((rows, ngrid), np.nan)
+
+    row_idx = np.arange(rows)
+    last = np.maximum(n_valid - 1, 0)
+    x_min = xs[:, 0]
+    x_max = xs[row_idx, last]
+
+    # One searchsorted over all rows: shift each row into its own,
+    # non-overlapping range of keys
+    lo = np.nanmin(x_min[good_rows])
+    span = np.nanmax(x_max[good_rows]) - lo
+    stride = 2. * span + 1.
+    offsets = row_idx[:, np.newaxis] * stride
+    keys = np.where(np.isnan(xs), span * 1.5, xs - lo) + offsets
+    g = np.clip(grid_x[np.newaxis, :], x_min[:, np.newaxis],
+                x_max[:, np.newaxis])
+    g_keys = (g - lo) + offsets
+    idx = (np.searchsorted(keys.ravel(), g_keys.ravel(), side='right')
+           .reshape(rows, ngrid) - row_idx[:, np.newaxis] * npts)
+    idx = np.clip(idx, 1, np.maximum(last, 1)[:, np.newaxis])
+
+    i0 = idx - 1
+    x0 = np.take_along_axis(xs, i0, axis=1)
+    x1 = np.take_along_axis(xs, idx, axis=1)
+    y0 = np.take_along_axis(ys, i0, axis=1)
+    y1 = np.take_along_axis(ys, idx, axis=1)
+    dx = x1 - x0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(dx > 0, (g - x0) / dx, 0.)
+
+    if kind == 'linear':
+        values = y0 + t * (y1 - y0)
+    else:
+        # Slopes from the neighbouring points, one-sided at the row ends
+        im1 = np.maximum(i0 - 1, 0)
+        ip2 = np.minimum(idx + 1, last[:, np.newaxis])
+        xm1 = np.take_along_axis(xs, im1, axis=1)
+        xp2 = np.take_along_axis(xs, ip2, axis=1)
+        ym1 = np.take_along_axis(ys, im1, axis=1)
+        yp2 = np.take_along_axis(ys, ip2, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            m0 = np.nan_to_num((y1 - ym1) / (x1 - xm1))
+            m1 = np.nan_to_num((yp2 - y0) / (xp2 - x0))
+        t2 = t * t
+        t3 = t2 * t
+        values = ((2 * t3 - 3 * t2 + 1) * y0 + (t3 - 2 * t2 + t) * dx * m0 +
+                  (-2 * t3 + 3 * t2) * y1 + (t3 - t2) * dx * m1)
+
+    outside = ((grid_x[np.newaxis, :] < x_min[:, np.newaxis]) |
+               (grid_x[np.newaxis, :] > x_max[:, np.newaxis]))
+    values[outside | ~good_rows[:, np.newaxis]] = np.nan
+    return values
+
+
+def benchmark_interp1d_scan(rows=1000, points=200, kind='linear',
+                            pyramid=True, repeat=3):
+    '''Time `interp1d_rows` against the per-row interp1d loop
+
+    Uses a synthetic flyscan with jittered readbacks and (optionally) flipped
+    odd rows, as in a pyramid scan.
+    '''
+    rng = np.random.RandomState(0)
+    grid_x = np.linspace(0., 10., points)
+    dx = grid_x[1] - grid_x[0]
+    x_data = grid_x + rng.normal(scale=0.2 * dx, size=(rows, points))
+    spectrum = np.sin(x_data)
+    if pyramid:
+        x_data[1::2, :] = x_data[1::2, ::-1]
+        spectrum[1::2, :] = spectrum[1::2, ::-1]
+
+    t_loop, loop_res = _best_of(
+        lambda: _interp1d_rows_loop(x_data, spectrum, grid_x, kind=kind),
+        repeat)
+    t_batch, batch_res = _best_of(
+        lambda: interp1d_rows(x_data, spectrum, grid_x, kind=kind), repeat)
+
+    both = np.isfinite(loop_res) & np.isfinite(batch_res)
+    max_diff = (np.max(np.abs(loop_res[both] - batch_res[both]))
+                if np.any(both) else np.nan)
+    print('{} rows x {} points ({}): loop {:.3f} s, batch {:.3f} s, '
+          'speedup {:.1f}x, max difference {:.3g}'
+          ''.format(rows, points, kind, t_loop, t_batch, t_loop / t_batch,
+                    max_diff))
+    return t_loop, t_batch
+
+
 def fly2d_reshape(hdr, spectrum, verbose=True):
-    '''Reshape a 1D array to match the shape of a 2D flyscan'''
+    '''Reshape a 1D array to match the shape of a 2D flyscan
+
+    Always returns a new array; see `fly2d_view` to avoid the copy.
+    '''
+    spectrum2 = fly2d_view(hdr, spectrum, pad=False, verbose=verbose)
+    if spectrum2 is not None and np.shares_memory(spectrum2, spectrum):
+        spectrum2 = spectrum2.copy()
+    return spectrum2
+
+
+def fly2d_view(hdr, spectrum, pad=True, fill_value=0, verbose=True):
+    '''Reshape a flyscan array to 2D, copying only when necessary
+
+    A complete raster scan gives a zero-copy (ny, nx) view of `spectrum`, so
+    writing to one changes the other. Pyramid scans (odd rows flipped) and
+    incomplete scans (padded with `fill_value` when `pad` is set) are
+    reshaped, padded and flipped in a single allocation.
+
+    Returns None if the data can not be reshaped.
+    '''
     try:
         nx, ny = get_flyscan_dimensions(hdr)
     except ValueError:
         raise ValueError('Not a 2D flyscan')
 
-    try:
-        spectrum2 = spectrum.copy().reshape((ny, nx))
-    except Exception as ex:
+    flat = np.asarray(spectrum).reshape(-1)
+    total_points = nx * ny
+    pyramid = hdr.get('fly_type') in ('pyramid', )
+
+    if flat.size != total_points:
+        if not pad or flat.size > total_points:
+            if verbose:
+                print('\tUnable to reshape data to (%d, %d) (points=%d)'
+                      '' % (nx, ny, flat.size))
+            return None
         if verbose:
-            print('\tUnable to reshape data to (%d, %d) (%s: %s)'
-                  '' % (nx, ny, ex.__class__.__name__, ex))
+            print('Padding data (points=%d expected=%d)' % (flat.size,
+                                                            total_points))
+    elif not pyramid:
+        return flat.reshape((ny, nx))
+
+    if pyramid and verbose:
+        print('\tPyramid scan. Flipping odd rows.')
+
+    spectrum2 = np.full((ny, nx), fill_value, dtype=flat.dtype)
+    full_rows, extra = divmod(flat.size, nx)
+    rows = flat[:full_rows * nx].reshape((full_rows, nx))
+    if pyramid:
+        spectrum2[0:full_rows:2] = rows[0::2]
+        spectrum2[1:full_rows:2] = rows[1::2, ::-1]
     else:
-        fly_type = hdr['fly_type']
-        if fly_type in ('pyramid', ):
-            # Pyramid scans' odd rows are flipped:
-            if verbose:
-                print('\tPyramid scan. Flipping odd rows.')
-            spectrum2[1::2, :] = spectrum2[1::2, ::-1]
+        spectrum2[:full_rows] = rows
+
+    if extra:
+        # The last, partial row is padded before it is flipped
+        tail = flat[full_rows * nx:]
+        if pyramid and full_rows % 2:
+            spectrum2[full_rows, nx - extra:] = tail[::-1]
+        else:
+            spectrum2[full_rows, :extra] = tail
+
+    return spectrum2
+
+
+# Format of the data files written by plot2dfly/plot2dfly_multi:
+#   'npz'  - one compressed numpy archive per scan
+#   'hdf5' - one chunked, gzip-compressed HDF5 file per scan
+#   'txt'  - the original np.savetxt text files
+plot2dfly_output_format = 'npz'
+_fly2d_output_ext = {'npz': '.npz', 'hdf5': '.h5', 'txt': ''}
+
+if '_plot2dfly_writer' not in globals():
+    # Don't lose queued writes when reloading this module via %run -i
+    _plot2dfly_writer = ThreadPoolExecutor(
+        max_workers=2, thread_name_prefix='plot2dfly-writer')
+    _plot2dfly_pending = set()
+
+
+def save_fly2d_output(folder, scan_id, elems, maps, x_data, y_data, spectra,
+                      *, x='x', y='y', fmt=None, multi=False):
+    '''Write 2D fly scan maps and positions in a background thread
+
+    Parameters
+    ----------
+    folder : str
+        Output folder
+    scan_id : int
+        Scan id, used in the file names
+    elems : list of str
+        Element names
+    maps : sequence of ndarray or None
+        One 2D map per element. None (the scan could not be shaped as a
+        2D map) writes only the data_x_y_ch_<scan_id> text file of the
+        positions and values, whatever the format.
+    x_data, y_data : ndarray
+        Positions of every point
+    spectra : sequence of ndarray
+        One 1D array of values per element, matching x_data/y_data
+    x, y : str, optional
+        Names of the position axes
+    fmt : {'npz', 'hdf5', 'txt'}, optional
+        Defaults to plot2dfly_output_format
+    multi : bool, optional
+        Use the plot2dfly_multi file names
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Resolves to the list of files written. The arrays are not copied,
+        so do not modify them until it is done. See `wait_fly2d_output`.
+    '''
+    if fmt is None:
+        fmt = plot2dfly_output_format
+    if fmt not in _fly2d_output_ext:
+        raise ValueError('Unknown output format: {!r}'.format(fmt))
+
+    basename = 'data_scan_{}'.format(scan_id) + ('_multi' if multi else '')
+    if maps is None:
+        fmt = 'txt'
+        maps = []
+        basename = 'data_x_y_ch_{}'.format(scan_id) + \
+            ('_multi' if multi else '')
+    print('\tSaving {} data to: {}{}'.format(
+        fmt, os.path.join(folder, basename), _fly2d_output_ext[fmt]))
+
+    future = _plot2dfly_writer.submit(
+        _write_fly2d_output, folder, scan_id, basename, list(elems), maps,
+        x_data, y_data, spectra, x, y, fmt, multi)
+    _plot2dfly_pending.add(future)
+    future.add_done_callback(_fly2d_output_done)
+    return future
+
+
+def wait_fly2d_output(timeout=None):
+    '''Wait for all queued plot2dfly data files to be written'''
+    for future in list(_plot2dfly_pending):
+        future.result(timeout=timeout)
+
+
+def _fly2d_output_done(future):
+    _plot2dfly_pending.discard(future)
+    ex = future.exception()
+    if ex is not None:
+        print('Failed to save plot2dfly data: ({}) {}'
+              ''.format(ex.__class__.__name__, ex))
+
 
-        return spectrum2
+def _write_fly2d_output(folder, scan_id, basename, elems, maps, x_data,
+                        y_data, spectra, x, y, fmt, multi):
+    if fmt == 'txt':
+        written = []
+        for elem, spectrum2 in zip(elems, maps):
+            path = os.path.join(folder, basename if not multi else
+                                'data_scan_{}_{}'.format(scan_id, elem))
+            np.savetxt(path, spectrum2)
+            written.append(path)
+
+        path = os.path.join(folder, 'data_x_y_ch_{}'.format(scan_id) +
+                            ('_multi' if multi else ''))
+        np.savetxt(path, np.vstack([x_data, y_data] + list(spectra)).T,
+                   header='\t'.join([x, y] + elems) if multi else '')
+        written.append(path)
+        return written
+
+    maps = np.stack(maps)
+    spectra = np.stack(spectra)
+    if fmt == 'npz':
+        path = os.path.join(folder, basename + _fly2d_output_ext[fmt])
+        np.savez_compressed(path, elems=np.array(elems), maps=maps,
+                            spectra=spectra, x=x_data, y=y_data,
+                            axes=np.array([x, y]))
+    else:
+        path = os.path.join(folder, basename + _fly2d_output_ext[fmt])
+        with h5py.File(path, 'w') as f:
+            f.attrs['scan_id'] = scan_id
+            f.attrs['elems'] = [elem.encode() for elem in elems]
+            f.create_dataset('maps', data=maps,
+                             chunks=(1, ) + maps.shape[1:],
+                             compression='gzip', shuffle=True)
+            f.create_dataset('spectra', data=spectra, chunks=True,
+                             compression='gzip', shuffle=True)
+            for name, data in ((x, x_data), (y, y_data)):
+                f.create_dataset('positions/' + name, data=data,
+                                 chunks=True, compression='gzip')
+    return [path]
 
 
 # TODO: change l, h to clim which defaults to 'auto'
 def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
               fill_events=False, cmap='viridis', cols=None,
-              channels=None, interp=None, interp2d=None):
+              channels=None, interp=None, interp2d=None, output_format=None,
+              render=None):
     """Plot the results of a 2d fly scan
 
     Parameters
@@ -450,6 +763,12 @@ def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
     interp2d : {'linear', 'cubic', 'quintic'}, optional
         Interpolate the data on the 2D mesh defined by positioners x and y,
         in both the x and y directions (NOTE: _extremely_ slow)
+    output_format : {'npz', 'hdf5', 'txt'}, optional
+        Format of the data files, written in the background.
+        Defaults to plot2dfly_output_format
+    render : bool, optional
+        Draw and save the figure. Defaults to analysis_render; without it
+        only the data files and the S_<scan>_<elem> variable are written
     """
 
     if channels is None:
@@ -484,9 +803,6 @@ def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
         monitor = np.asarray(df[norm], dtype=np.float32)
         spectrum = spectrum/(monitor + 1e-8)
 
-    nx, ny = get_flyscan_dimensions(hdr)
-    total_points = nx * ny
-
     if clim is None:
         clim = (np.nanmin(spectrum), np.nanmax(spectrum))
     extent = (np.nanmin(x_data), np.nanmax(x_data),
@@ -497,31 +813,19 @@ def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
             (abs(extent[2] - extent[3]) <= 0.001)):
         extent = None
 
-    dt = datetime.utcnow()
-    folder = os.path.join('/data/output/',
-                          '{}{:0>2}{:0>2}/'.format(dt.year, dt.month, dt.day))
-
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
+    folder = _plot2dfly_folder()
     print('Scan {}. Saving to: {}'.format(scan_id, folder))
 
-    if len(spectrum) != total_points:
-        print('Padding data (points=%d expected=%d)' % (len(spectrum),
-                                                        total_points))
-
-        _spectrum = np.zeros(total_points, dtype=spectrum.dtype)
-        _spectrum[:len(spectrum)] = spectrum
-        spectrum = _spectrum
-
     if interp2d is not None:
         print('\tUsing 2D %s interpolation...' % (interp2d, ), end=' ')
         sys.stdout.flush()
-        spectrum = interp2d_scan(hdr, x_data, y_data, spectrum,
-                                 kind=interp2d)
+        gridded = interp2d_scan(hdr, x_data, y_data, spectrum,
+                                kind=interp2d)
         print('done')
-
-    spectrum2 = fly2d_reshape(hdr, spectrum)
+        spectrum2 = fly2d_view(hdr, gridded)
+    else:
+        # Pads incomplete scans and flips pyramid rows in one allocation
+        spectrum2 = fly2d_view(hdr, spectrum)
 
     if interp is not None:
         print('\tUsing 1D %s interpolation...' % (interp, ), end=' ')
@@ -533,7 +837,9 @@ def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
     ax1 = None
     ax2 = None
 
-    if spectrum2 is None:
+    if not _render(render):
+        pass
+    elif spectrum2 is None:
         fig = figure_with_insert_fig_button()
         ax2 = plt.subplot(111)
     else:
@@ -542,8 +848,6 @@ def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
         fig.set_tight_layout(True)
         imshow = ax1.imshow(spectrum2, extent=extent, interpolation='None',
                             cmap=cmap, vmin=clim[0], vmax=clim[1])
-        np.savetxt(os.path.join(folder, 'data_scan_{}'.format(scan_id)),
-                   spectrum2)
 
         ax1.set_title('IMSHOW. ' + title)
         ax1.set_xlabel(x)
@@ -566,13 +870,14 @@ def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
         fig.colorbar(scatter)
 
     '''
-    fig_path = os.path.join(folder, 'data_scan_{}.png'.format(scan_id))
-    print('\tSaving figure to: {}'.format(fig_path))
-    fig.savefig(fig_path)
+    if fig is not None:
+        fig_path = os.path.join(folder, 'data_scan_{}.png'.format(scan_id))
+        print('\tSaving figure to: {}'.format(fig_path))
+        save_figure_async(fig, fig_path)
 
-    text_path = os.path.join(folder, 'data_x_y_ch_{}'.format(scan_id))
-    print('\tSaving text positions to: {}'.format(text_path))
-    np.savetxt(text_path, np.vstack((x_data, y_data, spectrum)).T)
+    save_fly2d_output(folder, scan_id, [elem],
+                      None if spectrum2 is None else [spectrum2], x_data,
+                      y_data, [spectrum], x=x, y=y, fmt=output_format)
 
     var_name = 'S_%d_%s' % (scan_id, elem)
     globals()[var_name] = spectrum2
@@ -580,55 +885,199 @@ def plot2dfly(scan_id, elem='Pt', norm=None, *, x=None, y=None, clim=None,
     return fig, ax1, ax2
 
 
+def _plot2dfly_folder():
+    '''The dated output folder used by plot2dfly, created if necessary'''
+    dt = datetime.utcnow()
+    folder = os.path.join('/data/output/',
+                          '{}{:0>2}{:0>2}/'.format(dt.year, dt.month, dt.day))
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+
+def _fly2d_roi_matrix(df, elems, channels):
+    '''Sum the ROI channels of several elements in one pass
+
+    Each element is either a column of `df` or the sum of its
+    'Det<channel>_<elem>' columns. Returns an (elements, points) float32
+    array.
+    '''
+    keys = []
+    weights = []
+    for elem in elems:
+        if elem in df:
+            elem_keys = [elem]
+        else:
+            elem_keys = ['Det%d_%s' % (chan, elem) for chan in channels]
+            for key in elem_keys:
+                if key not in df:
+                    raise KeyError('ROI %s not found' % (key, ))
+        row = []
+        for key in elem_keys:
+            if key not in keys:
+                keys.append(key)
+            row.append(keys.index(key))
+        weights.append(row)
+
+    columns = np.asarray(df[keys], dtype=np.float32).T
+    mixing = np.zeros((len(elems), len(keys)), dtype=np.float32)
+    for i, row in enumerate(weights):
+        mixing[i, row] = 1
+    return mixing @ columns
+
+
+def plot2dfly_multi(scan_id, elems, norm=None, *, x=None, y=None, clim=None,
+                    fill_events=False, cmap='viridis', channels=None,
+                    interp=None, ncols=None, output_format=None,
+                    render=None):
+    """Plot several elements of a 2d fly scan in one figure
+
+    The scan is loaded and normalized once, all element maps are computed
+    together and shown in a single grid of images. Arguments are as for
+    `plot2dfly`, except:
+
+    Parameters
+    ----------
+    elems : list of str
+        The elements to display
+    clim : tuple, optional
+        (min, max) used for every map. Defaults to each map's own min/max.
+    interp : {'linear', 'cubic'}, optional
+        Interpolate all maps over the fast-scanning direction at once
+    ncols : int, optional
+        Number of columns in the figure grid
+    output_format : {'npz', 'hdf5', 'txt'}, optional
+        Format of the data files, written in the background.
+        Defaults to plot2dfly_output_format
+    render : bool, optional
+        Draw and save the figure; defaults to analysis_render
+    """
+    if channels is None:
+        channels = [1, 2, 3]
+    elems = list(elems)
+
+    scan_id, df = _load_scan(scan_id, fill_events=fill_events)
+    hdr = db[scan_id]['start']
+    if x is None:
+        x = hdr['motor1']
+    x_data = np.asarray(df[x])
+
+    if y is None:
+        y = hdr['motor2']
+    y_data = np.asarray(df[y])
+
+    spectra = _fly2d_roi_matrix(df, elems, channels)
+    if norm is not None:
+        monitor = np.asarray(df[norm], dtype=np.float32)
+        spectra = spectra / (monitor + 1e-8)
+
+    extent = (np.nanmin(x_data), np.nanmax(x_data),
+              np.nanmax(y_data), np.nanmin(y_data))
+    if ((abs(extent[0] - extent[1]) <= 0.001) or
+            (abs(extent[2] - extent[3]) <= 0.001)):
+        extent = None
+
+    folder = _plot2dfly_folder()
+    print('Scan {}. Saving to: {}'.format(scan_id, folder))
+
+    maps = [fly2d_view(hdr, spectrum, verbose=(i == 0))
+            for i, spectrum in enumerate(spectra)]
+    if maps[0] is None:
+        raise ValueError('Unable to reshape scan {} to 2D'.format(scan_id))
+    maps = np.stack(maps)
+
+    if interp is not None:
+        print('\tUsing 1D %s interpolation...' % (interp, ), end=' ')
+        sys.stdout.flush()
+        grid_x, grid_y = fly2d_grid(hdr, x_data, y_data)
+        x2 = fly2d_view(hdr, x_data, fill_value=np.nan, verbose=False)
+        n_elem, ny, nx = maps.shape
+        maps = interp1d_rows(np.tile(x2, (n_elem, 1)),
+                             maps.reshape(n_elem * ny, nx), grid_x,
+                             kind=interp)
+        maps = maps.reshape(n_elem, ny, -1).astype(np.float32)
+        print('done')
+
+    fig = axes = None
+    if _render(render):
+        fig, axes = _plot2dfly_multi_figure(scan_id, elems, maps, extent,
+                                            clim, cmap, x, y, ncols)
+        fig_path = os.path.join(folder,
+                                'data_scan_{}_multi.png'.format(scan_id))
+        print('\tSaving figure to: {}'.format(fig_path))
+        save_figure_async(fig, fig_path)
+
+    save_fly2d_output(folder, scan_id, elems, maps, x_data, y_data, spectra,
+                      x=x, y=y, fmt=output_format, multi=True)
+
+    for elem, spectrum2 in zip(elems, maps):
+        globals()['S_%d_%s' % (scan_id, elem)] = spectrum2
+    print('\tScan data available in variables: {}'.format(
+        ', '.join('S_%d_%s' % (scan_id, elem) for elem in elems)))
+    return fig, axes
+
+
+def _plot2dfly_multi_figure(scan_id, elems, maps, extent, clim, cmap, x, y,
+                            ncols):
+    if ncols is None:
+        ncols = int(np.ceil(np.sqrt(len(elems))))
+    nrows = int(np.ceil(len(elems) / ncols))
+    fig, axes = plt.subplots(nrows, ncols, figsize=(4 * ncols, 3.5 * nrows),
+                             squeeze=False)
+    fig.set_tight_layout(True)
+    fig.suptitle('Scan id %s' % scan_id)
+    for ax in axes.flat[len(elems):]:
+        ax.set_visible(False)
+
+    for elem, spectrum2, ax in zip(elems, maps, axes.flat):
+        vmin, vmax = (clim if clim is not None else
+                      (np.nanmin(spectrum2), np.nanmax(spectrum2)))
+        imshow = ax.imshow(spectrum2, extent=extent, interpolation='None',
+                           cmap=cmap, vmin=vmin, vmax=vmax)
+        ax.set_title(elem)
+        ax.set_xlabel(x)
+        ax.set_ylabel(y)
+        fig.colorbar(imshow, ax=ax)
+    return fig, axes
+
+
 def export(sid, num=1,
            export_folder='/data/users/2019Q1/Jacobsen2019Q1',
            fields_excluded=['xspress3_ch1', 'xspress3_ch2',
-                            'xspress3_ch3', 'merlin2']):
-    for i in range(num):
-        #sid, df = _load_scan(sid, fill_events=False)
-        h = db[sid]
-        sid = h.start['scan_id']
-        df = h.table()
-        path = os.path.join(export_folder, 'scan_{}.txt'.format(sid))
-        print('Scan {}. Saving to {}'.format(sid, path))
-        # non_objects = [name for name, col in df.iteritems()
-        #               if col.dtype.name not in ('object', )]
-        non_objects = [name for name in df.keys()
-                       if name not in fields_excluded]
-        # print('fields inclued: {}'.format(sorted(non_objects)))
-        # dump all data
-        # non_objects = [name for name, col in df.iteritems()]
-        df.to_csv(path, float_format='%1.5e', sep='\t',
-                  columns=sorted(non_objects))
-        path = os.path.join(export_folder, 'scan_{}.h5'.format(sid))
-        filename = get_path(sid, 'merlin2')
-        num_subscan = len(filename)
-        if num_subscan == 1:
-            for fn in filename:
-                break
-            mycmd = ''.join(['cp', ' ', fn, ' ', path])
-            os.system(mycmd)
-        else:
-            imgs = list(h.data('merlin2'))
-            imgs = np.squeeze(imgs)
-            #path = os.path.join(export_folder, 'scan_{}.h5'.format(sid))
-            f = h5py.File(path, 'w')
-            dset = f.create_dataset('/entry/instrument/detector/data', data=imgs)
-            f.close()
-        print('Scan {}. Saving to {}'.format(sid, path))
-        sid = sid + 1
+                            'xspress3_ch3', 'merlin2'],
+           mode='copy', **kwargs):
+    '''Export the table and merlin2 frames of `num` scans from `sid` on
+
+    The scans are exported in parallel and can be resumed; see
+    export_scans for the keyword arguments. The frames are copied into
+    the export folder, so it can be taken home; mode='vds' or 'external'
+    only link the detector files (see link_frames_h5).
+    '''
+    sid = db[sid].start['scan_id']
+    return export_scans(range(sid, sid + num), export_folder, det='merlin2',
+                        fields_excluded=fields_excluded, mode=mode, **kwargs)
+
+
+def _header(scan, db=db):
+    """Header of a scan given as a header, uid or scan id."""
+    return scan if hasattr(scan, 'start') else db[scan]
 
 
 def get_path(scan_id, key_name='merlin1', db=db):
     """Return file path with given scan id and keyname.
+
+    The scan can also be given as a header or uid, which unlike a scan id
+    cannot refer to another run. The paths are unique and listed in the
+    order of the scan.
     """
     import os
-    h = db[scan_id]
+    h = _header(scan_id, db)
     e = list(db.get_events(h, fields=[key_name]))
     id_list = [v.data[key_name] for v in e]
     rootpath = db.reg.resource_given_datum_id(id_list[0])['root']
     flist = [db.reg.resource_given_datum_id(idv)['resource_path'] for idv in id_list]
-    flist = set(flist)
+    flist = list(dict.fromkeys(flist))
     fpath = [os.path.join(rootpath, file_path) for file_path in flist]
     return fpath
 
@@ -654,15 +1103,11 @@ def get_all_filenames(scan_id, key='merlin1'):
 def plot_img_sum2(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
     h = db[sid]
     sid = h.start['scan_id']
-    imgs = list(h.data(det))
-    #imgs = np.array(imgs)
-    imgs = np.array(np.squeeze(imgs))
     df = h.table()
     mon = np.array(df['sclr1_ch3'],dtype=float32)
     #figure_with_insert_fig_button()
     #plt.imshow(imgs[0],clim=[0,50])
-    if roi_flag:
-        imgs = imgs[:,x_cen-size//2:x_cen+size//2,y_cen-size//2:y_cen+size//2]
+    roi = (x_cen, y_cen, size) if roi_flag else None
 
     mots = h.start['motors']
     num_mots = len(mots)
@@ -671,9 +1116,8 @@ def plot_img_sum2(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
     if num_mots == 1:
         x = np.array(df[mots[0]])
 
-        imgs[imgs > 5000] = 0
-        tot = np.sum(imgs,2)
-        tot = np.array(np.sum(tot,1), dtype=float32)
+        tot = np.array(cached_frame_stats(sid, det, roi, clip=5000)['total'],
+                       dtype=float32)
         #tot = np.divide(tot,mon)
         #tot[tot > 70000] = 0
         figure_with_insert_fig_button()
@@ -685,10 +1129,13 @@ def plot_img_sum2(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
         plt.title('sid={}'.format(sid))
         #data_erf_fit(x,tot)
     elif num_mots == 2:
-        imgs[imgs > 1000] = 0
-        tot = np.sum(imgs,2)
-
-        tot = np.array(np.sum(tot,1),dtype=float32)
+        tot = np.array(cached_frame_stats(sid, det, roi, clip=1000)['total'],
+                       dtype=float32)
+        dim1 = h.start['num1']
+        dim2 = h.start['num2']
+        x = np.array(df[mots[0]])
+        y = np.array(df[mots[1]])
+        extent = (np.nanmin(x), np.nanmax(x),np.nanmax(y), np.nanmin(y))
         figure_with_insert_fig_button()
         #tot =np.divide(tot, mon)
         idx = np.where(abs(tot - np.mean(tot)) >3*np.std(tot))
@@ -702,15 +1149,12 @@ def plot_img_sum2(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
 def plot_img_sum(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
     h = db[sid]
     sid = h.start['scan_id']
-    imgs = list(h.data(det))
-    #imgs = np.array(imgs)
-    imgs = np.array(np.squeeze(imgs))
     df = h.table()
     mon = np.array(df['sclr1_ch3'],dtype=float32)
     #figure_with_insert_fig_button()
     #plt.imshow(imgs[0],clim=[0,50])
-    if roi_flag:
-        imgs = imgs[:,x_cen-size//2:x_cen+size//2,y_cen-size//2:y_cen+size//2]
+    roi = (x_cen, y_cen, size) if roi_flag else None
+    tot = np.array(cached_frame_stats(sid, det, roi)['total'], dtype=float32)
     mots = h.start['motors']
     num_mots = len(mots)
     #num_mots = 1
@@ -718,8 +1162,6 @@ def plot_img_sum(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
     if num_mots == 1:
         x = df[mots[0]]
         x = np.array(x)
-        tot = np.sum(imgs,2)
-        tot = np.array(np.sum(tot,1), dtype=float32)
         tot = np.divide(tot,mon)
         figure_with_insert_fig_button()
         plt.subplot(1,2,1)
@@ -730,8 +1172,6 @@ def plot_img_sum(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
         plt.title('sid={}'.format(sid))
         #data_erf_fit(x,tot)
     elif num_mots == 2:
-        tot = np.sum(imgs,2)
-        tot = np.array(np.sum(tot,1),dtype=float32)
         dim1 = h.start['num1']
         dim2 = h.start['num2']
         x = np.array(df[mots[0]])
@@ -0,0 +1,226 @@
+import contextlib
+import io
+import os
+import pickle
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+class _FigurePickler(pickle.Pickler):
+    '''Pickle a figure without asking the copy to register with pyplot
+
+    A figure managed by pyplot is pickled with `_restore_to_pylab` set, and
+    unpickling it would create a new GUI window. The copies rendered by
+    the export worker are drawn with Agg only, so that flag is dropped.
+    '''
+    def __init__(self, file, protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__(file, protocol)
+        self._protocol = protocol
+
+    def reducer_override(self, obj):
+        if not isinstance(obj, Figure):
+            return NotImplemented
+
+        func, args, state, *rest = obj.__reduce_ex__(self._protocol)
+        if isinstance(state, dict) and '_restore_to_pylab' in state:
+            state = dict(state)
+            state.pop('_restore_to_pylab')
+        return (func, args, state, *rest)
+
+
+def _snapshot_figure(fig):
+    '''Serialize the current state of a figure, on the calling thread'''
+    buf = io.BytesIO()
+    _FigurePickler(buf).dump(fig)
+    return buf.getvalue()
+
+
+def _render_figure(snapshot, path, kwargs):
+    '''Rasterize a figure snapshot to `path` using Agg'''
+    fig = pickle.loads(snapshot)
+    FigureCanvasAgg(fig)
+    fig.savefig(path, **kwargs)
+    return path
+
+
+class FigureExportService:
+    '''Save matplotlib figures on a worker thread
+
+    The figure is copied (pickled) on the calling thread, so the caller can
+    keep drawing on it, and the copy is rasterized on the worker with the
+    Agg backend. Saves to a path that is still waiting in the queue are
+    coalesced: the newest snapshot replaces the pending one and the same
+    future is returned.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of worker threads. One keeps saves to the same path in
+        order.
+    '''
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='figure-export')
+        self._lock = threading.Lock()
+        self._queued = {}
+        self._pending = set()
+        self.saved = 0
+        self.coalesced = 0
+
+    def submit(self, fig, path, *, coalesce=True, then=None, **kwargs):
+        '''Queue `fig` to be saved to `path`
+
+        Parameters
+        ----------
+        fig : matplotlib.figure.Figure
+        path : str
+            Output file name; the format follows the extension
+        coalesce : bool, optional
+            Replace a save to the same path that has not started yet
+        then : callable, optional
+            Called as then(path) on the worker once the file is written,
+            e.g. to send it to a printer
+        kwargs
+            Passed to Figure.savefig
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to the path of the written file
+        '''
+        path = os.path.abspath(path)
+        if kwargs.get('dpi') is None and \
+                matplotlib.rcParams['savefig.dpi'] == 'figure':
+            # the live figure dpi may be scaled for a HiDPI screen
+            kwargs['dpi'] = getattr(fig, '_original_dpi', fig.dpi)
+
+        try:
+            snapshot = _snapshot_figure(fig)
+        except Exception as ex:
+            print('\tFigure cannot be copied ({}); saving it in the '
+                  'foreground'.format(ex))
+            future = Future()
+            try:
+                fig.savefig(path, **kwargs)
+                if then is not None:
+                    then(path)
+            except Exception as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(path)
+            return future
+
+        job = (snapshot, kwargs, then)
+        with self._lock:
+            if coalesce and path in self._queued:
+                self._queued[path][0] = job
+                self.coalesced += 1
+                return self._queued[path][1]
+
+            slot = [job, None]
+            future = self._executor.submit(self._run, path, slot)
+            slot[1] = future
+            if coalesce:
+                self._queued[path] = slot
+            self._pending.add(future)
+
+        future.add_done_callback(self._done)
+        return future
+
+    def _run(self, path, slot):
+        with self._lock:
+            if self._queued.get(path) is slot:
+                del self._queued[path]
+            snapshot, kwargs, then = slot[0]
+
+        _render_figure(snapshot, path, kwargs)
+        if then is not None:
+            then(path)
+        return path
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        ex = future.exception()
+        if ex is not None:
+            print('\tFigure export failed: {!r}'.format(ex))
+        else:
+            self.saved += 1
+
+    def wait(self, timeout=None):
+        '''Block until all queued figures are written'''
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                # already reported by _done
+                pass
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+if 'figure_exporter' not in globals():
+    figure_exporter = FigureExportService()
+
+
+def save_figure_async(fig, path, **kwargs):
+    '''Save a figure in the background; see FigureExportService.submit'''
+    return figure_exporter.submit(fig, path, **kwargs)
+
+
+def print_figure(fig, printer='HXN-printer-1', path='~/temp.png', **kwargs):
+    '''Send a figure to a printer without blocking the session'''
+    path = os.path.expanduser(path)
+
+    def send(path):
+        subprocess.run(['lp', '-d', printer, path], check=True,
+                       stdout=subprocess.DEVNULL)
+
+    return figure_exporter.submit(fig, path, then=send, coalesce=False,
+                                  **kwargs)
+
+
+# Whether the analysis helpers (plot, plotfly, plot2dfly, erf_fit, ...)
+# draw figures; see analysis_context
+if 'analysis_render' not in globals():
+    analysis_render = True
+
+
+@contextlib.contextmanager
+def analysis_context(render=False):
+    '''Run the analysis helpers with or without figures
+
+    Inside the block, helpers whose `render` (or `plot`) argument is left
+    to None compute and return their results without creating figures.
+    Use it around unattended plans, e.g.
+
+        with analysis_context(render=False):
+            RE(theta_fly2d_mll(...))
+    '''
+    global analysis_render
+    previous = analysis_render
+    analysis_render = render
+    try:
+        yield
+    finally:
+        analysis_render = previous
+
+
+def headless_plan(plan):
+    '''Run a plan with the analysis helpers not drawing figures'''
+    with analysis_context(render=False):
+        return (yield from plan)
+
+
+def _render(render):
+    '''Resolve the render argument of an analysis helper'''
+    return analysis_render if render is None else render
@@ -0,0 +1,871 @@
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import h5py
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Default dataset path of the exported detector frames
+EXPORT_DATASET = '/entry/instrument/detector/data'
+
+
+def _expected_frames(h, stream='primary'):
+    '''Number of events in a stream, if the run recorded it'''
+    try:
+        return int(h.stop['num_events'][stream])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _frame_blocks(frames, block_size):
+    '''Group an iterable of frames into (n, ny, nx) blocks
+
+    Every datum is squeezed; a datum holding several images (3D after the
+    squeeze) contributes all of them. Only one block is held in memory.
+    '''
+    block = None
+    n = 0
+    for frame in frames:
+        frame = np.squeeze(np.asarray(frame))
+        images = frame[np.newaxis] if frame.ndim == 2 else frame
+        for image in images:
+            if block is None:
+                block = np.empty((block_size, ) + image.shape, image.dtype)
+            block[n] = image
+            n += 1
+            if n == block_size:
+                yield block
+                n = 0
+    if n:
+        yield block[:n]
+
+
+def write_frames_h5(frames, path, *, dataset=EXPORT_DATASET, n_frames=None,
+                    block_size=64, compression=None, compression_opts=None,
+                    report_every=1000, mode='w'):
+    '''Stream detector frames into a chunked HDF5 dataset
+
+    Parameters
+    ----------
+    frames : iterable of array_like
+        Frames in scan order, e.g. `h.data('merlin1')`
+    path : str
+        Output HDF5 file
+    dataset : str, optional
+        Name of the dataset to create
+    n_frames : int, optional
+        Expected number of frames, used to preallocate the dataset. The
+        dataset is resized if the actual number differs.
+    block_size : int, optional
+        Frames buffered in memory between writes
+    compression : {None, 'gzip', 'lzf'}, optional
+        HDF5 compression filter
+    compression_opts : int, optional
+        Compression level for gzip
+    report_every : int, optional
+        Print progress every this many frames; 0 disables it
+    mode : str, optional
+        Mode used to open the file
+
+    Returns
+    -------
+    n : int
+        Number of frames written
+    '''
+    t0 = time.monotonic()
+    n = 0
+    next_report = report_every
+    with h5py.File(path, mode) as f:
+        dset = None
+        for block in _frame_blocks(frames, block_size):
+            if dset is None:
+                size = n_frames if n_frames else block_size
+                frame_shape = block.shape[1:]
+                dset = f.create_dataset(
+                    dataset, shape=(size, ) + frame_shape,
+                    maxshape=(None, ) + frame_shape, dtype=block.dtype,
+                    chunks=(1, ) + frame_shape, compression=compression,
+                    compression_opts=compression_opts)
+
+            stop = n + len(block)
+            if stop > dset.shape[0]:
+                dset.resize(max(stop, 2 * dset.shape[0]), axis=0)
+            dset[n:stop] = block
+            n = stop
+
+            if report_every and n >= next_report:
+                rate = n / (time.monotonic() - t0)
+                total = '/{}'.format(n_frames) if n_frames else ''
+                print('\t{}{} frames written ({:.0f} frames/s)'.format(
+                    n, total, rate))
+                sys.stdout.flush()
+                next_report = (n // report_every + 1) * report_every
+
+        if dset is None:
+            raise ValueError('No frames to export to {}'.format(path))
+        if dset.shape[0] != n:
+            dset.resize(n, axis=0)
+
+    if report_every:
+        print('\t{} frames written to {} in {:.1f} s'.format(
+            n, path, time.monotonic() - t0))
+    return n
+
+
+def export_frames_h5(scan_id, det, path, **kwargs):
+    '''Export the frames of one detector of a scan without loading them all
+
+    Frames are read one event at a time from the databroker and written
+    in blocks to a chunked dataset, so memory use does not depend on the
+    length of the scan. The scan can be a header, uid or scan id. See
+    `write_frames_h5` for the keyword arguments.
+    '''
+    h = _header(scan_id)
+    kwargs.setdefault('n_frames', _expected_frames(h))
+    return write_frames_h5(h.data(det), path, **kwargs)
+
+
+# ioctl request to clone a file (reflink) on btrfs/xfs, from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def copy_file(src, dst):
+    '''Copy a file in-process, sharing its blocks when possible
+
+    A reflink clone is tried first, which is instantaneous on filesystems
+    that support it; otherwise shutil.copyfile is used, which copies in
+    the kernel with sendfile on Linux. Returns the method used.
+    '''
+    if fcntl is not None:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def file_checksum(path, algorithm='sha256', block_size=4 * 1024 * 1024):
+    '''Hex digest of a file, read in blocks'''
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_files(pairs, *, workers=4, verify=True, algorithm='sha256'):
+    '''Copy (src, dst) pairs in parallel and optionally verify checksums
+
+    Destination folders are created as needed. The throughput of the
+    copy is printed at the end.
+
+    Returns
+    -------
+    mismatched : list of (src, dst)
+        Pairs whose checksums differ after the copy
+    '''
+    pairs = [(src, dst) for src, dst in pairs]
+
+    def copy(pair):
+        src, dst = pair
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        method = copy_file(src, dst)
+        if verify and method != 'reflink':
+            # a reflink shares the source blocks, there is nothing to check
+            with ThreadPoolExecutor(2) as hashers:
+                sums = list(hashers.map(file_checksum, (src, dst),
+                                        (algorithm, algorithm)))
+            if sums[0] != sums[1]:
+                return pair
+        return None
+
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(workers, 'export-copy') as pool:
+        mismatched = [pair for pair in pool.map(copy, pairs)
+                      if pair is not None]
+    elapsed = time.monotonic() - t0
+    size = sum(os.path.getsize(src) for src, dst in pairs)
+    print('\tCopied {} file(s), {:.1f} MB in {:.1f} s ({:.1f} MB/s)'.format(
+        len(pairs), size / 1e6, elapsed, size / 1e6 / max(elapsed, 1e-6)))
+    for src, dst in mismatched:
+        print('\tChecksum mismatch: {} -> {}'.format(src, dst))
+    return mismatched
+
+
+# How export_detector_h5 stores detector frames: 'vds' (virtual dataset
+# over the original files), 'external' (one external link per file) or
+# 'copy' (the frames are copied into the export file)
+export_link_mode = 'vds'
+
+
+def _source_shapes(paths, dataset):
+    '''Shape and dtype of the frame dataset in each source file'''
+    shapes = []
+    dtype = None
+    for fn in paths:
+        with h5py.File(fn, 'r') as f:
+            dset = f[dataset]
+            if dset.ndim != 3:
+                raise ValueError('{}:{} has shape {}; expected (frames, y, x)'
+                                 ''.format(fn, dataset, dset.shape))
+            if dtype is None:
+                dtype = dset.dtype
+            shapes.append(dset.shape)
+    if len({shape[1:] for shape in shapes}) > 1:
+        raise ValueError('Source files have different frame shapes: {}'
+                         ''.format(shapes))
+    return shapes, dtype
+
+
+def _iter_source_frames(paths, dataset, block_size=64):
+    '''Yield frame blocks read directly from the source HDF5 files'''
+    for fn in paths:
+        with h5py.File(fn, 'r') as f:
+            dset = f[dataset]
+            for start in range(0, dset.shape[0], block_size):
+                yield dset[start:start + block_size]
+
+
+def link_frames_h5(paths, path, *, mode='vds', dataset=EXPORT_DATASET,
+                   source_dataset=EXPORT_DATASET, **kwargs):
+    '''Make `dataset` in `path` present the frames of several source files
+
+    Parameters
+    ----------
+    paths : list of str
+        Source HDF5 files, in scan order
+    path : str
+        Output HDF5 file
+    mode : {'vds', 'external', 'copy'}, optional
+        'vds' creates a virtual dataset stitching the source datasets
+        together, so nothing is copied. 'external' creates an external
+        link to each source dataset instead: `dataset` itself for a single
+        file, or `dataset`_<n> for several. 'copy' streams the frames into
+        a regular dataset (see `write_frames_h5`); a single source file
+        that already has the layout of the export is copied as a whole
+        (see `copy_files`).
+    dataset : str, optional
+        Name of the dataset in the output file
+    source_dataset : str, optional
+        Name of the frame dataset in the source files
+    kwargs
+        Passed to `write_frames_h5` in 'copy' mode
+
+    Returns
+    -------
+    n : int
+        Number of frames exported
+    '''
+    paths = [os.path.abspath(fn) for fn in paths]
+    if not paths:
+        raise ValueError('No source files to export to {}'.format(path))
+
+    if mode == 'copy':
+        if len(paths) == 1 and dataset == source_dataset:
+            # the detector file already has the export layout
+            if copy_files([(paths[0], path)]):
+                raise OSError('Checksum mismatch copying {}'.format(paths[0]))
+            with h5py.File(path, 'r') as f:
+                return f[dataset].shape[0]
+        blocks = _iter_source_frames(paths, source_dataset)
+        shapes, _ = _source_shapes(paths, source_dataset)
+        kwargs.setdefault('n_frames', sum(shape[0] for shape in shapes))
+        return write_frames_h5(blocks, path, dataset=dataset, **kwargs)
+
+    shapes, dtype = _source_shapes(paths, source_dataset)
+    n = sum(shape[0] for shape in shapes)
+    with h5py.File(path, 'w') as f:
+        if mode == 'vds':
+            layout = h5py.VirtualLayout(shape=(n, ) + shapes[0][1:],
+                                        dtype=dtype)
+            start = 0
+            for fn, shape in zip(paths, shapes):
+                source = h5py.VirtualSource(fn, source_dataset, shape=shape)
+                layout[start:start + shape[0]] = source
+                start += shape[0]
+            f.create_virtual_dataset(dataset, layout)
+        elif mode == 'external':
+            if len(paths) == 1:
+                f[dataset] = h5py.ExternalLink(paths[0], source_dataset)
+            else:
+                for i, fn in enumerate(paths):
+                    name = '{}_{:04d}'.format(dataset, i)
+                    f[name] = h5py.ExternalLink(fn, source_dataset)
+        else:
+            raise ValueError('Unknown export mode: {!r}'.format(mode))
+
+    print('\t{} frames from {} file(s) linked into {} ({})'.format(
+        n, len(paths), path, mode))
+    return n
+
+
+def export_detector_h5(scan_id, det, path, *, mode=None, **kwargs):
+    '''Export the frames of a detector, linking its files when possible
+
+    The default mode is `export_link_mode`. The frames are streamed from
+    the databroker instead if the detector files cannot be read directly
+    (e.g. they are not HDF5). Pass the header or uid of the scan rather
+    than its scan id when the id may have been reused by another run.
+    '''
+    mode = export_link_mode if mode is None else mode
+    scan_id = _header(scan_id)
+    try:
+        paths = get_path(scan_id, det)
+        return link_frames_h5(paths, path, mode=mode, **kwargs)
+    except (OSError, KeyError, ValueError) as ex:
+        print('\tCannot export {} from its files ({}); streaming frames '
+              'instead'.format(det, ex))
+        return export_frames_h5(scan_id, det, path)
+
+
+# Format of the scan tables written by export_table and export_scans:
+# 'tsv' (fast tab-separated text), 'csv' (the same text written with
+# pandas to_csv), 'parquet', 'feather' or 'hdf5'
+export_table_format = 'tsv'
+
+_table_suffix = {'tsv': '.txt', 'csv': '.txt', 'parquet': '.parquet',
+                 'feather': '.feather', 'hdf5': '_table.h5'}
+
+_FLOAT_WIDTH = 13
+_DIGITS = np.frombuffer(b'0123456789', dtype=np.uint8)
+
+
+def _float_cells(values):
+    '''Format floats as '%1.5e' into an (n, 13) byte buffer and a mask
+
+    The digits are computed with array arithmetic instead of a format
+    call per value. The last digit can differ from '%1.5e' for values
+    that fall within rounding error of a halfway point. NaN becomes an
+    empty cell, like in to_csv.
+    '''
+    x = np.asarray(values, dtype=np.float64)
+    n = len(x)
+    a = np.abs(x)
+    finite = np.isfinite(x)
+    nonzero = finite & (a > 0)
+
+    e = np.zeros(n, dtype=np.int64)
+    e[nonzero] = np.floor(np.log10(a[nonzero]))
+    m = np.zeros(n, dtype=np.int64)
+    # log10 can be off by one next to powers of ten, and rounding can
+    # carry into a seventh digit; both are fixed by adjusting e
+    for _ in range(2):
+        # scale subnormal values in two steps so 10**scale stays finite
+        scale = 5 - e[nonzero]
+        first = np.where(scale > 300, scale - 300, 0)
+        m[nonzero] = np.rint(a[nonzero] * 10.0 ** first *
+                             10.0 ** (scale - first))
+        fix = nonzero & ((m >= 1000000) | (m < 100000))
+        if not fix.any():
+            break
+        e[fix] += np.where(m[fix] >= 1000000, 1, -1)
+
+    buf = np.empty((n, _FLOAT_WIDTH), dtype=np.uint8)
+    mask = np.ones((n, _FLOAT_WIDTH), dtype=bool)
+    buf[:, 0] = ord('-')
+    mask[:, 0] = np.signbit(x)
+    for col in range(7, 2, -1):
+        buf[:, col] = _DIGITS[m % 10]
+        m //= 10
+    buf[:, 1] = _DIGITS[m % 10]
+    buf[:, 2] = ord('.')
+    buf[:, 8] = ord('e')
+    buf[:, 9] = np.where(e < 0, ord('-'), ord('+'))
+    exp = np.abs(e)
+    for col in range(12, 9, -1):
+        buf[:, col] = _DIGITS[exp % 10]
+        exp //= 10
+    mask[:, 10] = np.abs(e) >= 100
+
+    inf = np.isinf(x)
+    if inf.any():
+        buf[inf, 1:4] = np.frombuffer(b'inf', dtype=np.uint8)
+        mask[inf, 4:] = False
+    mask[np.isnan(x)] = False
+    return buf, mask
+
+
+def _text_cells(values):
+    '''Any other column as an (n, width) byte buffer and a mask
+
+    Missing values (None, NaN, NaT) become empty cells, like in to_csv.
+    '''
+    if values.dtype.kind in 'iub':
+        cells = values.astype('S')
+    else:
+        if values.dtype.kind == 'M':
+            text = pd.DatetimeIndex(values).astype(str).to_numpy(dtype=str)
+        else:
+            text = values.astype(str)
+        cells = np.char.encode(np.where(pd.isna(values), '', text), 'utf-8')
+    width = max(cells.dtype.itemsize, 1)
+    buf = np.frombuffer(cells.astype('S{}'.format(width)).tobytes(),
+                        dtype=np.uint8).reshape(len(cells), width)
+    return buf, buf != 0
+
+
+def _column_cells(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        return _float_cells(values)
+    return _text_cells(values)
+
+
+def write_tsv(df, path, columns=None, chunk_rows=100000):
+    '''Write a table as tab-separated text, like to_csv(float_format='%1.5e')
+
+    Each column is formatted as a whole into a byte buffer; the rows are
+    assembled by dropping the unused bytes of the buffer, without
+    formatting values one at a time.
+    '''
+    columns = list(df.columns) if columns is None else list(columns)
+    index_name = df.index.name or ''
+    n = len(df)
+    with open(path, 'wb') as f:
+        f.write('\t'.join([index_name] + [str(c) for c in columns])
+                .encode('utf-8') + b'\n')
+        for start in range(0, n, chunk_rows):
+            stop = min(start + chunk_rows, n)
+            rows = stop - start
+            sep = np.full((rows, 1), ord('\t'), dtype=np.uint8)
+            bufs, masks = [], []
+            cells = [df.index[start:stop]] + \
+                [df[c].to_numpy()[start:stop] for c in columns]
+            for values in cells:
+                buf, mask = _column_cells(values)
+                bufs += [buf, sep]
+                masks += [mask, np.ones((rows, 1), dtype=bool)]
+            bufs[-1] = np.full((rows, 1), ord('\n'), dtype=np.uint8)
+            buf = np.concatenate(bufs, axis=1)
+            f.write(buf[np.concatenate(masks, axis=1)].tobytes())
+    return path
+
+
+def _write_table_hdf5(df, path, columns):
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('table')
+        group.attrs['columns'] = [str(c) for c in columns]
+        group.attrs['index'] = df.index.name or 'index'
+        for name, values in [(group.attrs['index'], df.index)] + \
+                [(c, df[c]) for c in columns]:
+            values = np.asarray(values)
+            if values.dtype.kind == 'M':
+                values = values.astype('datetime64[ns]').view(np.int64)
+            elif values.dtype.kind not in 'iufb':
+                values = np.char.encode(np.array([str(v) for v in values],
+                                                 dtype=str), 'utf-8')
+            group.create_dataset(str(name), data=values)
+    return path
+
+
+def write_table(df, path, fmt=None, columns=None):
+    '''Write a table in one of the export formats
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    path : str
+    fmt : {'tsv', 'csv', 'parquet', 'feather', 'hdf5'}, optional
+        Defaults to `export_table_format`. Parquet and Feather need
+        pyarrow.
+    columns : list of str, optional
+        Columns to write, in order; the index is always written
+
+    Returns
+    -------
+    path : str
+    '''
+    fmt = export_table_format if fmt is None else fmt
+    columns = list(df.columns) if columns is None else list(columns)
+    if fmt == 'tsv':
+        return write_tsv(df, path, columns)
+    elif fmt == 'csv':
+        df.to_csv(path, float_format='%1.5e', sep='\t', columns=columns)
+    elif fmt == 'parquet':
+        df[columns].to_parquet(path)
+    elif fmt == 'feather':
+        df[columns].reset_index().to_feather(path)
+    elif fmt == 'hdf5':
+        _write_table_hdf5(df, path, columns)
+    else:
+        raise ValueError('Unknown table format: {!r}'.format(fmt))
+    return path
+
+
+def benchmark_write_tsv(rows=100000, columns=30, repeat=3):
+    '''Time write_tsv against to_csv and compare their output
+
+    Besides the float columns, the table has an integer column, an object
+    column with None and NaN and a time column with NaT, which both
+    writers must leave empty.
+    '''
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(rng.normal(size=(rows, columns)) *
+                      10.0 ** rng.randint(-8, 8, size=(rows, columns)),
+                      columns=['col{}'.format(i) for i in range(columns)])
+    df.iloc[::97, 0] = np.nan
+    df['seq_num'] = np.arange(rows)
+    df['det'] = np.array(['merlin1', None, np.nan, 'xspress3'],
+                         dtype=object)[np.arange(rows) % 4]
+    df['time'] = pd.Timestamp('2020-01-01') + pd.to_timedelta(
+        np.arange(rows), unit='s')
+    df.loc[df.index[::89], 'time'] = pd.NaT
+    df.index.name = 'index'
+
+    folder = tempfile.mkdtemp()
+    tsv_path = os.path.join(folder, 'table.txt')
+    csv_path = os.path.join(folder, 'table_csv.txt')
+    try:
+        t_csv, _ = _best_of(lambda: df.to_csv(
+            csv_path, float_format='%1.5e', sep='\t'), repeat)
+        t_tsv, _ = _best_of(lambda: write_tsv(df, tsv_path), repeat)
+        with open(csv_path, 'rb') as f:
+            csv_lines = f.read().splitlines()
+        with open(tsv_path, 'rb') as f:
+            tsv_lines = f.read().splitlines()
+    finally:
+        shutil.rmtree(folder)
+    different = sum(a != b for a, b in zip(csv_lines, tsv_lines)) + \
+        abs(len(csv_lines) - len(tsv_lines))
+    print('{} x {} table: to_csv {:.2f} s, write_tsv {:.2f} s, {} of {} '
+          'lines differ'.format(rows, df.shape[1], t_csv, t_tsv, different,
+                                len(csv_lines)))
+    return t_csv, t_tsv, different
+
+
+def table_path(folder, scan_id, fmt=None):
+    '''Name of the table file of a scan for an export format'''
+    fmt = export_table_format if fmt is None else fmt
+    return os.path.join(folder, 'scan_{}{}'.format(scan_id,
+                                                   _table_suffix[fmt]))
+
+
+def export_table(scan_id, fmt=None, folder='.', columns=None,
+                 fields_excluded=()):
+    '''Write the table of a scan to `folder`; see `write_table`'''
+    h = db[scan_id]
+    df = h.table()
+    if columns is None:
+        columns = sorted(name for name in df.keys()
+                         if name not in fields_excluded)
+    path = table_path(folder, h.start['scan_id'], fmt)
+    print('Scan {}. Saving to {}'.format(h.start['scan_id'], path))
+    return write_table(df, path, fmt, columns)
+
+
+class ExportManifest:
+    '''Record of the export stages completed for each scan
+
+    The manifest is a JSON file mapping scan ids to the stages that have
+    finished. It is rewritten atomically after every stage, so an export
+    that is interrupted can be restarted and skips the work already done.
+    Use `ExportManifest.get` to share one instance per file within the
+    session; marking a stage also merges the stages written to the file
+    by any other writer, under a lock file.
+    '''
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._scans = self._read()
+
+    @classmethod
+    def get(cls, path):
+        '''The shared manifest of `path`'''
+        key = os.path.abspath(path)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(path)
+            return cls._instances[key]
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with open(self.path + '.lock', 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def done(self, scan_id, stage):
+        with self._lock:
+            return stage in self._scans.get(str(scan_id), {})
+
+    def mark(self, scan_id, stage, path):
+        with self._lock, self._file_lock():
+            scans = self._read()
+            for sid, stages in self._scans.items():
+                scans.setdefault(sid, {}).update(stages)
+            scans.setdefault(str(scan_id), {})[stage] = path
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(os.path.abspath(self.path)),
+                    prefix='.export_manifest', suffix='.tmp',
+                    delete=False) as f:
+                json.dump(scans, f, indent=1, sort_keys=True)
+            os.replace(f.name, self.path)
+            self._scans = scans
+
+
+def export_scans(scan_ids, folder, *, det='merlin1', columns=None,
+                 fields_excluded=(), table_format=None, read_workers=4,
+                 io_workers=2, write_workers=2, manifest=True, mode=None):
+    '''Export the tables and detector frames of many scans in parallel
+
+    Each scan goes through three stages which overlap across scans: the
+    header and table are read in one thread pool, the table is written
+    (see `write_table`) in a second one and the detector frames are
+    exported (see `export_detector_h5`) in a third.
+
+    Parameters
+    ----------
+    scan_ids : iterable of int
+    folder : str or callable
+        Export folder, or a function returning the folder for a scan id
+    det : str or None, optional
+        Detector whose frames are exported; None exports tables only
+    columns : list of str, optional
+        Table columns to write; by default all columns not in
+        `fields_excluded`, sorted
+    fields_excluded : list of str, optional
+    table_format : str, optional
+        Format of the tables, see `write_table`
+    read_workers, io_workers, write_workers : int, optional
+        Size of the read, frame export and table writer pools
+    manifest : bool or str, optional
+        Path of the manifest used to resume an interrupted export. True
+        puts `export_manifest.json` in `folder` (which must be a string);
+        False disables it.
+    mode : {'vds', 'external', 'copy'}, optional
+        How the detector frames are stored, see `link_frames_h5`; by
+        default `export_link_mode`
+
+    Returns
+    -------
+    failed : dict
+        Scan ids that failed, mapped to the exception raised
+    '''
+    scan_ids = list(scan_ids)
+    folder_for = folder if callable(folder) else (lambda sid: folder)
+    if manifest is True:
+        manifest = os.path.join(folder, 'export_manifest.json')
+    manifest = ExportManifest.get(manifest) if manifest else None
+
+    def is_done(sid, stage):
+        return manifest is not None and manifest.done(sid, stage)
+
+    def finished(sid, stage, path):
+        if manifest is not None:
+            manifest.mark(sid, stage, path)
+
+    def read(sid):
+        h = db[sid]
+        sid = h.start['scan_id']
+        df = None if is_done(sid, 'table') else h.table()
+        return h, sid, df
+
+    def write_scan_table(sid, df):
+        out = folder_for(sid)
+        os.makedirs(out, exist_ok=True)
+        cols = columns
+        if cols is None:
+            cols = sorted(name for name in df.keys()
+                          if name not in fields_excluded)
+        path = write_table(df, table_path(out, sid, table_format),
+                           table_format, cols)
+        finished(sid, 'table', path)
+        return path
+
+    def write_frames(h, sid):
+        out = folder_for(sid)
+        os.makedirs(out, exist_ok=True)
+        path = os.path.join(out, 'scan_{}.h5'.format(sid))
+        export_detector_h5(h, det, path, mode=mode)
+        finished(sid, 'frames', path)
+        return path
+
+    t0 = time.monotonic()
+    failed = {}
+    jobs = {}
+    with ThreadPoolExecutor(read_workers, 'export-read') as readers, \
+            ThreadPoolExecutor(io_workers, 'export-io') as io, \
+            ThreadPoolExecutor(write_workers, 'export-write') as writers:
+        reads = {readers.submit(read, sid): sid for sid in scan_ids
+                 if not (is_done(sid, 'table') and
+                         (det is None or is_done(sid, 'frames')))}
+        for future in as_completed(reads):
+            try:
+                h, sid, df = future.result()
+            except Exception as ex:
+                failed[reads[future]] = ex
+                continue
+            if df is not None:
+                jobs[writers.submit(write_scan_table, sid, df)] = sid
+            if det is not None and not is_done(sid, 'frames'):
+                jobs[io.submit(write_frames, h, sid)] = sid
+
+        for future in as_completed(jobs):
+            sid = jobs[future]
+            try:
+                print('Scan {}. Saved {}'.format(sid, future.result()))
+            except Exception as ex:
+                failed[sid] = ex
+
+    for sid, ex in sorted(failed.items()):
+        print('Scan {}. Export failed: {!r}'.format(sid, ex))
+    print('Exported {} scans in {:.1f} s'.format(
+        len(scan_ids) - len(failed), time.monotonic() - t0))
+    return failed
+
+
+ExportPolicy = collections.namedtuple(
+    'ExportPolicy', 'folder det columns fields_excluded table_format')
+ExportPolicy.__new__.__defaults__ = ('merlin1', None, (), None)
+ExportPolicy.__doc__ = '''How the scans of one proposal are exported
+
+folder is formatted with the scan_id and proposal_id of each scan, e.g.
+'/data/users/{proposal_id}/export'. det, columns, fields_excluded and
+table_format are passed to the exporters (det=None exports the table
+only).
+'''
+
+# Export policies of the ExportWatcher, keyed by proposal id; the None key
+# is used for scans without a policy of their own. Scans with no matching
+# policy are not exported.
+if 'export_policies' not in globals():
+    export_policies = {}
+
+
+class ExportWatcher:
+    '''Export every scan in the background as soon as it finishes
+
+    Subscribe it to the RunEngine with `enable`. When a stop document
+    arrives the scan is queued on a worker pool and exported according to
+    the policy of its proposal (see ExportPolicy). A failed export is
+    retried after `backoff`, 2 * `backoff`, ... seconds; scans that still
+    fail are kept in `failed` and can be queued again with
+    `retry_failed`. Completed stages are recorded in the manifest of the
+    destination folder, so export_scans skips them later.
+    '''
+    def __init__(self, policies, max_workers=2, retries=3, backoff=30):
+        self.policies = policies
+        self.retries = retries
+        self.backoff = backoff
+        self.failed = {}
+        self._executor = ThreadPoolExecutor(max_workers, 'export-watcher')
+        self._lock = threading.Lock()
+        self._proposals = {}
+        self._tokens = []
+
+    def enable(self, RE):
+        '''Start exporting the scans run by `RE`'''
+        if not self._tokens:
+            self._tokens = [RE.subscribe(self, name)
+                            for name in ('start', 'stop')]
+            self._RE = RE
+
+    def disable(self):
+        '''Stop queueing new scans; queued exports still finish'''
+        for token in self._tokens:
+            self._RE.unsubscribe(token)
+        self._tokens = []
+
+    def __call__(self, name, doc):
+        if name == 'start':
+            self._proposals[doc['uid']] = doc.get('proposal_id')
+        elif name == 'stop':
+            proposal_id = self._proposals.pop(doc['run_start'], None)
+            if doc.get('exit_status') == 'fail':
+                return
+            self.queue(doc['run_start'], proposal_id)
+
+    def policy(self, proposal_id):
+        return self.policies.get(proposal_id, self.policies.get(None))
+
+    def queue(self, uid, proposal_id=None, attempt=0):
+        '''Export a scan with the policy of `proposal_id`'''
+        policy = self.policy(proposal_id)
+        if policy is None:
+            return None
+        return self._executor.submit(self._export, uid, proposal_id, policy,
+                                     attempt)
+
+    def retry_failed(self):
+        with self._lock:
+            failed, self.failed = self.failed, {}
+        for uid, (proposal_id, ex) in failed.items():
+            self.queue(uid, proposal_id)
+
+    def _export(self, uid, proposal_id, policy, attempt):
+        try:
+            h = db[uid]
+            sid = h.start['scan_id']
+            folder = policy.folder.format(scan_id=sid,
+                                          proposal_id=proposal_id)
+            os.makedirs(folder, exist_ok=True)
+            manifest = ExportManifest.get(
+                os.path.join(folder, 'export_manifest.json'))
+
+            if not manifest.done(sid, 'table'):
+                df = h.table()
+                columns = policy.columns
+                if columns is None:
+                    columns = sorted(name for name in df.keys()
+                                     if name not in policy.fields_excluded)
+                path = write_table(df, table_path(folder, sid,
+                                                  policy.table_format),
+                                   policy.table_format, columns)
+                manifest.mark(sid, 'table', path)
+            if policy.det is not None and not manifest.done(sid, 'frames'):
+                path = os.path.join(folder, 'scan_{}.h5'.format(sid))
+                # the header, not the scan id, which may have been reused
+                export_detector_h5(h, policy.det, path)
+                manifest.mark(sid, 'frames', path)
+        except Exception as ex:
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                print('\tExport of scan {} failed ({!r}); retrying in {} s'
+                      ''.format(uid[:8], ex, delay))
+                timer = threading.Timer(delay, self.queue,
+                                        (uid, proposal_id, attempt + 1))
+                timer.daemon = True
+                timer.start()
+            else:
+                print('\tExport of scan {} failed: {!r}'.format(uid[:8], ex))
+                with self._lock:
+                    self.failed[uid] = (proposal_id, ex)
+            return None
+        return sid
+
+
+if 'export_watcher' not in globals():
+    export_watcher = ExportWatcher(export_policies)
+# export_watcher.enable(RE)
@@ -0,0 +1,288 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+
+def _roi_slices(roi):
+    '''Slices of a (x_cen, y_cen, size) ROI on the two image axes
+
+    As in plot_img_sum, x_cen indexes the first image axis and y_cen the
+    second one.
+    '''
+    if roi is None:
+        return slice(None), slice(None)
+    x_cen, y_cen, size = roi
+    return (slice(max(x_cen - size // 2, 0), x_cen + size // 2),
+            slice(max(y_cen - size // 2, 0), y_cen + size // 2))
+
+
+def _block_stats(block, row0, col0, out):
+    '''Append the statistics of a block of frames to the lists in `out`'''
+    profile_x = block.sum(axis=2)
+    profile_y = block.sum(axis=1)
+    tot = profile_x.sum(axis=1)
+    out['total'].append(tot)
+    out['max'].append(block.max(axis=(1, 2)) if block.size
+                      else np.zeros(len(block)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['com_x'].append(profile_x @ np.arange(profile_x.shape[1]) / tot +
+                            row0)
+        out['com_y'].append(profile_y @ np.arange(profile_y.shape[1]) / tot +
+                            col0)
+
+
+class ImageStack:
+    '''Lazy, chunked access to the frames of an area detector in a scan
+
+    Frames are read directly from the detector HDF5 files, a block of
+    frames at a time, and only the ROI hyperslab is read when a ROI is
+    given. If the files cannot be used (not HDF5, or their frame count
+    does not match the scan) the frames are streamed from the databroker
+    instead. Either way, memory use depends on `block_size`, not on the
+    length of the scan.
+
+    Parameters
+    ----------
+    scan_id : int or str
+    det : str, optional
+        Detector name
+    block_size : int, optional
+        Number of frames read at a time
+    dataset : str, optional
+        Frame dataset in the detector files
+    '''
+    def __init__(self, scan_id, det='merlin1', block_size=256,
+                 dataset=EXPORT_DATASET):
+        self.header = db[scan_id]
+        self.scan_id = self.header.start['scan_id']
+        self.uid = self.header.start['uid']
+        self.det = det
+        self.block_size = block_size
+        self.dataset = dataset
+        self.paths = self._source_paths()
+
+    def _source_paths(self):
+        try:
+            paths = get_path(self.uid, self.det)
+            shapes, _ = _source_shapes(paths, self.dataset)
+        except (OSError, KeyError, ValueError, IndexError):
+            return None
+        expected = _expected_frames(self.header)
+        if expected is not None and \
+                sum(shape[0] for shape in shapes) != expected:
+            return None
+        return paths
+
+    def blocks(self, roi=None):
+        '''Yield (n, ny, nx) blocks of frames, cropped to `roi`'''
+        rows, cols = _roi_slices(roi)
+        if self.paths is not None:
+            for fn in self.paths:
+                with h5py.File(fn, 'r') as f:
+                    dset = f[self.dataset]
+                    for start in range(0, dset.shape[0], self.block_size):
+                        stop = start + self.block_size
+                        yield dset[start:stop, rows, cols]
+        else:
+            frames = self.header.data(self.det)
+            for block in _frame_blocks(frames, self.block_size):
+                yield block[:, rows, cols]
+
+    def frame_stats(self, roi=None, clip=None):
+        '''Per-frame statistics over the whole frame or a ROI
+
+        Parameters
+        ----------
+        roi : tuple, optional
+            (x_cen, y_cen, size), as used by plot_img_sum
+        clip : float, optional
+            Pixels above this value are counted as 0 (hot pixels)
+
+        Returns
+        -------
+        stats : dict
+            'total', 'max' and the center of mass 'com_x', 'com_y' of each
+            frame. The center of mass is in pixels of the full frame,
+            along the first and second image axes, and NaN for empty
+            frames.
+        '''
+        return self.frame_stats_many([roi], clip, hyperslab=True)[0]
+
+    def frame_stats_many(self, rois, clip=None, hyperslab=False):
+        '''frame_stats for several ROIs in a single pass over the frames
+
+        Full frames are read, unless `hyperslab` is set and there is one
+        ROI. Returns a list with the statistics of each ROI.
+        '''
+        rois = list(rois)
+        slices = [_roi_slices(roi) for roi in rois]
+        parts = [{'total': [], 'max': [], 'com_x': [], 'com_y': []}
+                 for roi in rois]
+        read_roi = rois[0] if hyperslab and len(rois) == 1 else None
+        for block in self.blocks(read_roi):
+            block = np.asarray(block, dtype=np.float64)
+            if clip is not None:
+                block[block > clip] = 0
+            for (rows, cols), part in zip(slices, parts):
+                if read_roi is None:
+                    sub = block[:, rows, cols]
+                else:
+                    sub = block
+                _block_stats(sub, rows.start or 0, cols.start or 0, part)
+
+        return [{key: np.concatenate(values) if values else np.zeros(0)
+                 for key, values in part.items()} for part in parts]
+
+    def totals(self, roi=None, clip=None):
+        '''Sum of each frame, or of its ROI'''
+        return self.frame_stats(roi, clip)['total']
+
+
+# ROIs whose statistics are computed together whenever a scan is read for
+# the frame statistics cache, as name: (x_cen, y_cen, size) or None for
+# the full frame
+if 'frame_stats_rois' not in globals():
+    frame_stats_rois = {'full': None}
+
+
+class FrameStatsCache:
+    '''Persistent cache of per-frame statistics of area detector scans
+
+    Statistics (see ImageStack.frame_stats) are keyed by (uid, detector,
+    ROI, clip), kept in memory and saved as one .npz file per key under
+    `folder`. A miss reads the scan once and fills the entries of the
+    requested ROI and of all the ROIs in `frame_stats_rois`. Only scans
+    that have finished are cached. A key being computed is not computed
+    again: other callers wait for its result.
+
+    Subscribed to the stop documents of the RunEngine (see `enable`), it
+    fills the cache of `dets` in the background as soon as a scan ends.
+    '''
+    def __init__(self, folder, dets=('merlin1', ), rois=None):
+        self.folder = folder
+        self.dets = dets
+        self.rois = frame_stats_rois if rois is None else rois
+        self._memory = {}
+        # keys being computed: Future of their statistics
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1, 'frame-stats')
+        self._tokens = []
+
+    def _path(self, key):
+        uid, det, roi, clip = key
+        roi = 'full' if roi is None else '{}_{}_{}'.format(*roi)
+        return os.path.join(self.folder, '{}_{}_{}_{}.npz'.format(
+            uid, det, roi, clip))
+
+    def get(self, uid, det, roi=None, clip=None):
+        '''Cached statistics, or None'''
+        key = (uid, det, roi, clip)
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key]
+        try:
+            with np.load(self._path(key)) as f:
+                stats = {name: f[name] for name in f.files}
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self._memory[key] = stats
+        return stats
+
+    def put(self, uid, det, roi, clip, stats):
+        key = (uid, det, roi, clip)
+        with self._lock:
+            self._memory[key] = stats
+        os.makedirs(self.folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp.npz', dir=self.folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **stats)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def stats(self, scan_id, det='merlin1', roi=None, clip=None):
+        '''Per-frame statistics of a scan, computed on the first call'''
+        uid = db[scan_id].start['uid']
+        stats = self.get(uid, det, roi, clip)
+        if stats is not None:
+            return stats
+
+        extra = [r for r in self.rois.values() if r != roi and
+                 self.get(uid, det, r, clip) is None]
+        with self._lock:
+            pending = self._pending.get((uid, det, roi, clip))
+            if pending is None:
+                rois = [roi] + [r for r in extra
+                                if (uid, det, r, clip) not in self._pending]
+                futures = [Future() for r in rois]
+                for r, future in zip(rois, futures):
+                    self._pending[(uid, det, r, clip)] = future
+        if pending is not None:
+            return pending.result()
+
+        try:
+            stack = ImageStack(uid, det)
+            if len(rois) == 1:
+                results = [stack.frame_stats(roi, clip)]
+            else:
+                results = stack.frame_stats_many(rois, clip)
+            if stack.header.stop:
+                for r, result in zip(rois, results):
+                    self.put(uid, det, r, clip, result)
+        except BaseException as ex:
+            for future in futures:
+                future.set_exception(ex)
+            raise
+        else:
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        finally:
+            with self._lock:
+                for r in rois:
+                    del self._pending[(uid, det, r, clip)]
+        return results[0]
+
+    def enable(self, RE):
+        '''Fill the cache in the background when a scan finishes'''
+        if not self._tokens:
+            self._tokens = [RE.subscribe(self, 'stop')]
+            self._RE = RE
+
+    def disable(self):
+        for token in self._tokens:
+            self._RE.unsubscribe(token)
+        self._tokens = []
+
+    def __call__(self, name, doc):
+        if name == 'stop' and doc.get('exit_status') != 'fail':
+            self._executor.submit(self._fill, doc['run_start'])
+
+    def _fill(self, uid):
+        h = db[uid]
+        for det in self.dets:
+            if det not in h.start.get('detectors', [det]):
+                continue
+            try:
+                self.stats(uid, det)
+            except Exception as ex:
+                print('\tFrame statistics of {} in scan {} failed: {!r}'
+                      ''.format(det, h.start['scan_id'], ex))
+
+
+if 'frame_stats_cache' not in globals():
+    frame_stats_cache = FrameStatsCache(
+        os.path.expanduser('~/.cache/hxn_frame_stats'))
+# frame_stats_cache.enable(RE)
+
+
+def cached_frame_stats(sid, det='merlin1', roi=None, clip=None):
+    '''Per-frame statistics of a scan from the frame statistics cache'''
+    return frame_stats_cache.stats(sid, det, roi, clip)
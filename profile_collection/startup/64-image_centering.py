@@ -0,0 +1,332 @@
+import collections
+import threading
+
+import bluesky.plan_stubs as bps
+import numpy as np
+
+
+XRFMap = collections.namedtuple(
+    'XRFMap', 'scan_id uid elem image x y nx ny x_motor y_motor step_x step_y')
+XRFMap.__doc__ = '''A normalized fluorescence map of a 2D step scan
+
+image is (ny, nx); x and y are the flat motor positions of the points in
+scan order; step_x and step_y are the nominal step sizes.
+'''
+
+# Maps kept in memory by load_xrf_map, most recently used last
+_xrf_maps = collections.OrderedDict()
+_xrf_maps_lock = threading.Lock()
+xrf_map_cache_size = 64
+
+
+def load_xrf_map(scan_id=-1, elem='Pt', norm='sclr1_ch4', channels=None,
+                 x_field=None, y_field=None):
+    '''Normalized fluorescence map of a scan, cached in memory
+
+    Only the ROI, monitor and motor columns are read. Maps of finished
+    scans are kept (by uid, element, monitor and position columns), so
+    centering the same scan again does not touch the database table.
+    x_field and y_field are the columns read as the x and y positions;
+    by default the scan's motor1 and motor2.
+    '''
+    h = db[scan_id]
+    uid = h.start['uid']
+    key = (uid, elem, norm, None if channels is None else tuple(channels),
+           x_field, y_field)
+    with _xrf_maps_lock:
+        if key in _xrf_maps:
+            _xrf_maps.move_to_end(key)
+            return _xrf_maps[key]
+
+    hdr = h.start
+    x_motor = hdr['motor1'] if x_field is None else x_field
+    y_motor = hdr['motor2'] if y_field is None else y_field
+    nx = hdr['plan_args']['num1']
+    ny = hdr['plan_args']['num2']
+    if channels is None:
+        channels = [1, 2, 3]
+    fields = ([elem] if elem in h.fields() else
+              ['Det%d_%s' % (chan, elem) for chan in channels])
+    fields += [name for name in (norm, x_motor, y_motor) if name is not None]
+    df = h.table(fields=fields, fill=False)
+
+    xrf = _fly2d_roi_matrix(df, [elem], channels)[0].astype(np.float64)
+    if norm is not None:
+        xrf /= np.asarray(df[norm], dtype=np.float64)
+    xrf_map = XRFMap(
+        scan_id=hdr['scan_id'], uid=uid, elem=elem,
+        image=xrf.reshape(ny, nx),
+        x=np.asarray(df[x_motor]), y=np.asarray(df[y_motor]),
+        nx=nx, ny=ny, x_motor=x_motor, y_motor=y_motor,
+        step_x=(hdr['scan_end1'] - hdr['scan_start1']) / nx,
+        step_y=(hdr['scan_end2'] - hdr['scan_start2']) / ny)
+
+    if h.stop:
+        with _xrf_maps_lock:
+            _xrf_maps[key] = xrf_map
+            while len(_xrf_maps) > xrf_map_cache_size:
+                _xrf_maps.popitem(last=False)
+    return xrf_map
+
+
+def _pixel_to_motor(xrf_map, iy, ix):
+    '''Motor positions of fractional pixel coordinates'''
+    x = xrf_map.x.reshape(xrf_map.ny, xrf_map.nx).mean(axis=0)
+    y = xrf_map.y.reshape(xrf_map.ny, xrf_map.nx).mean(axis=1)
+    return (np.interp(ix, np.arange(xrf_map.nx), x),
+            np.interp(iy, np.arange(xrf_map.ny), y))
+
+
+def _edge_center(profile):
+    '''Middle of the steepest rising and falling edges of a profile'''
+    grad = np.gradient(np.asarray(profile, dtype=np.float64))
+    rise = np.argmax(grad)
+    fall = np.argmin(grad)
+    return (rise + fall) / 2.
+
+
+def _upsampled_dft(data, size, upsample, offsets):
+    '''Upsampled inverse DFT of a batch of spectra around given offsets
+
+    data is (n, ny, nx); offsets is (n, 2), the position of the first
+    output sample in upsampled pixels. Returns (n, size, size). Computed
+    with matrix products, so only the region of interest is evaluated.
+    '''
+    n, ny, nx = data.shape
+    samples = np.arange(size)
+    kern_y = np.exp(2j * np.pi * (samples[None, :, None] -
+                                  offsets[:, 0, None, None]) *
+                    np.fft.fftfreq(ny, upsample)[None, None, :])
+    kern_x = np.exp(2j * np.pi * (samples[None, :, None] -
+                                  offsets[:, 1, None, None]) *
+                    np.fft.fftfreq(nx, upsample)[None, None, :])
+    return np.einsum('nky,nyx,nlx->nkl', kern_y, data, kern_x)
+
+
+def _prepare_image(image):
+    image = np.asarray(image, dtype=np.float64)
+    return image - image.mean(axis=(-2, -1), keepdims=True)
+
+
+def phase_correlation(ref, images, upsample=20, ref_fft=None,
+                      normalize=False):
+    '''Subpixel shifts of images relative to a reference
+
+    FFT cross-correlation gives the integer shift; it is refined to
+    1/`upsample` pixel with an upsampled DFT around the peak
+    (Guizar-Sicairos et al., Opt. Lett. 33, 156 (2008)).
+
+    Parameters
+    ----------
+    ref : (ny, nx) array_like
+    images : (ny, nx) or (n, ny, nx) array_like
+        Registered all at once
+    upsample : int, optional
+        Subpixel precision is 1 / upsample; 1 gives integer shifts
+    ref_fft : ndarray, optional
+        Precomputed `reference_fft(ref)`, e.g. cached across calls
+    normalize : bool, optional
+        Whiten the cross-power spectrum (true phase correlation). This
+        sharpens the peak for maps with edges and fine structure, but
+        amplifies the noise of smooth, blurry maps, so it is off by
+        default.
+
+    Returns
+    -------
+    shifts : (2, ) or (n, 2) ndarray
+        (dy, dx) such that each image is the reference moved by +shift
+        pixels
+    '''
+    images = np.asarray(images)
+    single = images.ndim == 2
+    stack = _prepare_image(images[np.newaxis] if single else images)
+    if ref_fft is None:
+        ref_fft = reference_fft(ref)
+
+    product = np.fft.fft2(stack) * np.conj(ref_fft)
+    if normalize:
+        product /= np.maximum(np.abs(product), 1e-12 * np.abs(product).max())
+    corr = np.abs(np.fft.ifft2(product))
+
+    n, ny, nx = stack.shape
+    peaks = np.array(np.unravel_index(
+        np.argmax(corr.reshape(n, -1), axis=1), (ny, nx))).T.astype(float)
+    dims = np.array([ny, nx])
+    shifts = np.where(peaks > dims // 2, peaks - dims, peaks)
+
+    if upsample > 1:
+        shifts = np.round(shifts * upsample) / upsample
+        size = int(np.ceil(upsample * 1.5))
+        center = np.fix(size / 2.)
+        offsets = center - shifts * upsample
+        upsampled = np.abs(_upsampled_dft(product, size, upsample, offsets))
+        fine = np.array(np.unravel_index(
+            np.argmax(upsampled.reshape(n, -1), axis=1), (size, size))).T
+        shifts = shifts + (fine - center) / upsample
+
+    return shifts[0] if single else shifts
+
+
+def reference_fft(ref):
+    '''FFT of a reference image, as used by phase_correlation'''
+    return np.fft.fft2(_prepare_image(ref))
+
+
+# FFTs of reference maps, keyed by (uid, elem, norm, threshold)
+_ref_ffts = collections.OrderedDict()
+
+
+def _registration_image(xrf_map, threshold):
+    image = xrf_map.image
+    if threshold is not None:
+        image = image.copy()
+        image[image < threshold * image.max()] = 0
+    return image
+
+
+def register_scans(scan_ids, ref, elem='Pt', threshold=0.2, upsample=20,
+                   normalize=False, norm='sclr1_ch4'):
+    '''Shifts of several scans relative to a reference scan
+
+    The maps are loaded with load_xrf_map (and cached), pixels below
+    threshold * max are ignored, and all scans are registered at once
+    against the cached FFT of the reference.
+
+    Returns
+    -------
+    shifts : (n, 2) ndarray
+        (dx, dy) in motor units: how far the features moved from the
+        reference scan to each scan
+    '''
+    ref_map = ref if isinstance(ref, XRFMap) else \
+        load_xrf_map(ref, elem, norm)
+    key = (ref_map.uid, elem, norm, threshold)
+    with _xrf_maps_lock:
+        ref_fft = _ref_ffts.get(key)
+    if ref_fft is None:
+        ref_fft = reference_fft(_registration_image(ref_map, threshold))
+        with _xrf_maps_lock:
+            _ref_ffts[key] = ref_fft
+            while len(_ref_ffts) > xrf_map_cache_size:
+                _ref_ffts.popitem(last=False)
+
+    maps = [sid if isinstance(sid, XRFMap) else load_xrf_map(sid, elem, norm)
+            for sid in scan_ids]
+    images = np.array([_registration_image(m, threshold) for m in maps])
+    shifts = phase_correlation(None, images, upsample, ref_fft=ref_fft,
+                               normalize=normalize)
+    steps = np.array([[m.step_y, m.step_x] for m in maps])
+    return (shifts * steps)[:, ::-1]
+
+
+def image_shift(scan_id=-1, ref=-2, elem='Pt', **kwargs):
+    '''(dx, dy) shift of a scan relative to a reference scan, in motor
+    units; see register_scans'''
+    return tuple(register_scans([scan_id], ref, elem, **kwargs)[0])
+
+
+def image_center(scan_id=-1, elem='Pt', method='com', threshold=None,
+                 bitmask=False, ref=None, subpixel=False, norm='sclr1_ch4',
+                 x_field=None, y_field=None):
+    '''Center of a fluorescence map in motor coordinates
+
+    Parameters
+    ----------
+    scan_id : int, str or XRFMap
+        Scan (or an already loaded map)
+    elem : str
+        Element or ROI column
+    method : {'com', 'edge', 'xcorr'}, optional
+        'com' is the center of mass; 'edge' the middle of the steepest
+        edges of the projections on each axis; 'xcorr' follows the
+        center of the map `ref` into this scan by phase correlation
+        (register_scans). The feature is assumed to be centered in the
+        reference map, so the result is the middle pixel of `ref` moved
+        by the shift.
+    threshold : float, optional
+        For 'com' and 'xcorr', ignore pixels below threshold * max
+    bitmask : bool, optional
+        For 'com', weigh the pixels above the threshold equally (the
+        bitflag of the mov_to_image_* plans)
+    ref : int, str or XRFMap, optional
+        Reference scan for 'xcorr'
+    subpixel : bool, optional
+        Interpolate the motor positions between pixels. By default the
+        positions of the nearest scan point are returned, as the
+        mov_to_image_* plans did.
+    x_field, y_field : str, optional
+        Position columns, see load_xrf_map
+
+    Returns
+    -------
+    x_cen, y_cen : float
+    '''
+    xrf_map = (scan_id if isinstance(scan_id, XRFMap) else
+               load_xrf_map(scan_id, elem, norm, x_field=x_field,
+                            y_field=y_field))
+    image = xrf_map.image
+    if method == 'com':
+        iy, ix = com_2d(image, threshold, bitmask)
+    elif method == 'edge':
+        iy = _edge_center(image.sum(axis=1))
+        ix = _edge_center(image.sum(axis=0))
+    elif method == 'xcorr':
+        if ref is None:
+            raise ValueError("method='xcorr' needs a reference scan")
+        (dx, dy), = register_scans([xrf_map], ref, elem, threshold,
+                                   norm=norm)
+        iy = xrf_map.ny / 2 + dy / xrf_map.step_y
+        ix = xrf_map.nx / 2 + dx / xrf_map.step_x
+    else:
+        raise ValueError('Unknown centering method: {!r}'.format(method))
+
+    if subpixel:
+        return _pixel_to_motor(xrf_map, iy, ix)
+
+    ix = min(max(int(np.round(ix)), 0), xrf_map.nx - 1)
+    iy = min(max(int(np.round(iy)), 0), xrf_map.ny - 1)
+    i_max = ix + iy * xrf_map.nx
+    return xrf_map.x[i_max], xrf_map.y[i_max]
+
+
+def image_center_plan(scan_id=-1, elem='Pt', motors=None, offsets=(0, 0),
+                      **kwargs):
+    '''Move to the center of a fluorescence map (plan stub)
+
+    Parameters
+    ----------
+    motors : tuple of positioners, optional
+        (x, y) motors moved to the center; by default the motors the
+        map was scanned with
+    offsets : tuple of float, optional
+        Added to the (x, y) center
+    kwargs
+        Passed to image_center
+
+    Returns
+    -------
+    x_cen, y_cen : float
+        The center, without the offsets
+    '''
+    norm = kwargs.pop('norm', 'sclr1_ch4')
+    xrf_map = load_xrf_map(scan_id, elem, norm,
+                           x_field=kwargs.pop('x_field', None),
+                           y_field=kwargs.pop('y_field', None))
+    x_cen, y_cen = image_center(xrf_map, elem, norm=norm, **kwargs)
+    if motors is None:
+        motors = (_scan_motor(xrf_map.x_motor), _scan_motor(xrf_map.y_motor))
+    print('move {} to {}, {} to {}'.format(
+        motors[0].name, x_cen + offsets[0], motors[1].name,
+        y_cen + offsets[1]))
+    yield from bps.mov(motors[0], x_cen + offsets[0],
+                       motors[1], y_cen + offsets[1])
+    return x_cen, y_cen
+
+
+def _scan_motor(name):
+    '''Positioner of a scanned motor from its name, e.g. 'dssx' '''
+    for device in (smlld, zps):
+        motor = getattr(device, name, None)
+        if motor is not None:
+            return motor
+    raise KeyError('No motor named {!r}'.format(name))
@@ -29,9 +29,8 @@ def focusmerlin(cnttime):
 
 
 def printfig():
-    plt.savefig('/home/xf03id/temp.png', bbox_inches='tight',
-                pad_inches=4)
-    os.system("lp -d HXN-printer-1 /home/xf03id/temp.png")
+    return print_figure(plt.gcf(), path='/home/xf03id/temp.png',
+                        bbox_inches='tight', pad_inches=4)
 
 
 def shutter(cmd):
@@ -450,55 +449,16 @@ def rot_fit_2(x, y):
     plt.show()
     return popt[0], popt[1], popt[2]
 
-def find_mass_center(array):
-    n = np.size(array)
-    tmp = 0
-    for i in range(n):
-        tmp += i * array[i]
-    mc = np.round(tmp / np.sum(array))
-    return mc
-
 def find_mass_center_1d(array,x):
-    n = np.size(array)
-    tmp = 0
-    for i in range(n):
-        tmp += x[i] *array[i]
-    mc = tmp / np.sum(array)
+    mc = com_1d(array, x)
     return mc
 
 def mov_to_image_center_tmp(scan_id=-1, elem='Au_L', bitflag=1, moveflag=1,piezomoveflag=1):
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    hdr = db[scan_id]['start']
-    x_motor = hdr['motor1']
-    y_motor = hdr['motor2']
-    x = np.asarray(df2[x_motor])
-    y = np.asarray(df2[y_motor])
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-    xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    if bitflag:
-        xrf[xrf <= 0.2*np.max(xrf)] = 0.
-        xrf[xrf > 0.2*np.max(xrf)] = 1.
-
-    #plt.figure()
-    #plt.imshow(xrf)
-
-    b = ndimage.measurements.center_of_mass(xrf)
-
-    iy = np.int(np.round(b[0]))
-    ix = np.int(np.round(b[1]))
-    i_max = ix + iy * nx
-
-    x_cen = x[i_max]
-    y_cen = y[i_max]
+    xrf_map = load_xrf_map(scan_id, elem)
+    x_motor = xrf_map.x_motor
+    x_cen, y_cen = image_center(xrf_map, elem,
+                                threshold=0.2 if bitflag else None,
+                                bitmask=bool(bitflag))
 
     #xrf_proj = np.sum(xrf,axis=1)
     #xrf_proj_d = xrf_proj - np.roll(xrf_proj,1,0)
@@ -2340,60 +2300,18 @@ def plot_fermat(scan_id,elem='Ga',norm=1):
 
 
 def return_center_of_mass(scan_id = -1, elem = 'Cr'):
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    x = np.asarray(df2.zpssx)
-    y = np.asarray(df2.zpssy)
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-    xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    b = ndimage.measurements.center_of_mass(xrf)
-
-    iy = np.int(np.round(b[0]))
-    ix = np.int(np.round(b[1]))
-    i_max = ix + iy * nx
-
-    x_cen = x[i_max]
-    y_cen = y[i_max]
+    xrf_map = load_xrf_map(scan_id, elem, x_field='zpssx', y_field='zpssy')
+    x_cen, y_cen = image_center(xrf_map, elem)
     return (y_cen, x_cen)
 
 
 
 def mov_to_image_cen_zpsx(scan_id=-1, elem='Ni', bitflag=1):
 
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    x = np.asarray(df2.zpssx)
-    y = np.asarray(df2.zpssy)
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-    xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    if bitflag:
-        xrf[xrf <= 0.25*np.max(xrf)] = 0.
-        xrf[xrf > 0.25*np.max(xrf)] = 1.
-
-    b = ndimage.measurements.center_of_mass(xrf)
-
-    iy = np.int(np.round(b[0]))
-    ix = np.int(np.round(b[1]))
-    i_max = ix + iy * nx
-
-    x_cen = x[i_max]
-    y_cen = y[i_max]
+    xrf_map = load_xrf_map(scan_id, elem, x_field='zpssx', y_field='zpssy')
+    x_cen, y_cen = image_center(xrf_map, elem,
+                                threshold=0.25 if bitflag else None,
+                                bitmask=bool(bitflag))
     print('move zpsx by', x_cen)
     #print('move zpssx, zpssy to ',0, 0)
 
@@ -2404,17 +2322,8 @@ def mov_to_image_cen_zpsx(scan_id=-1, elem='Ni', bitflag=1):
 
 
 def retreat_xrf_roi(scan_id = -1, elem='Au', bitflag=1):
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-    xrf = np.asarray(np.reshape(xrf,(ny,nx)))
+    # copy, the map itself is cached
+    xrf = load_xrf_map(scan_id, elem).image.copy()
     max_xrf=np.max(xrf)
 
     if bitflag:
@@ -2426,75 +2335,23 @@ def retreat_xrf_roi(scan_id = -1, elem='Au', bitflag=1):
 
 def mov_to_image_cen_corr_dsx(scan_id=-1, elem='Pt',bitflag=1, moveflag=1):
     print(scan_id)
-    image_ref = retreat_xrf_roi(scan_id-2, elem,bitflag)
-    image = retreat_xrf_roi(scan_id,elem,bitflag)
-    corr = signal.correlate2d(image_ref, image, boundary='symm', mode='same')
-    #nx,ny = np.shape(image)
-    max_y,max_x = np.where(corr == np.max(corr))
-
-    df2 = db.get_table(db[scan_id],fill=False)
-    hdr = db[scan_id]['start']
-    x_motor = hdr['motor1']
-    y_motor = hdr['motor2']
-    x = np.asarray(df2[x_motor])
-    y = np.asarray(df2[y_motor])
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    step_x_um = (hdr['scan_end1'] - hdr['scan_start1']) / nx
-    step_y_um = (hdr['scan_end2'] - hdr['scan_start2']) / ny
-
+    xrf_map = load_xrf_map(scan_id, elem)
+    dx_um, dy_um = image_shift(xrf_map, scan_id-2, elem,
+                               threshold=0.2 if bitflag else None)
+    step_x_um = xrf_map.step_x
 
-    dx_um = -1*(max_x - nx/2) * step_x_um
-    dy_um = -1*(max_y - ny/2) * step_y_um
-
-    if x_motor == 'dssx':
+    if xrf_map.x_motor == 'dssx':
         print('move dsx by', -dx_um)
         if moveflag:
             if np.abs(dx_um)>step_x_um:
                 movr(smlld.dsx, -dx_um)
 
-    if x_motor == 'dssz':
+    if xrf_map.x_motor == 'dssz':
         print('move dsz by', dx_um)
         if moveflag:
             if np.abs(dx_um)>step_x_um:
                 movr(smlld.dsz, dx_um)
 
-    '''
-    image_ref_crop = image_ref[:,nx/4:nx*3/4]
-    image_crop = image[:,nx/4:nx*3/4]
-    corr_crop = signal.correlate2d(image_ref_crop, image_crop, boundary='symm', mode='same')
-    max_y_crop,max_x_crop = np.where(corr_crop == np.max(corr_crop))
-    dy_um_crop = -1*(max_y_crop - ny/2) * step_y_um
-    plt.figure()
-    plt.subplot(221)
-    plt.imshow(image_ref_crop)
-    plt.subplot(222)
-    plt.imshow(image_crop)
-    plt.subplot(223)
-    plt.imshow(corr_crop)
-    plt.show()
-    '''
-
-    ly_ref = np.sum(image_ref,axis=1)
-    ly = np.sum(image,axis=1)
-    corr_1d = np.correlate(np.squeeze(ly_ref),np.squeeze(ly),'same')
-    max_y= np.where(corr_1d == np.max(corr_1d))
-    #print(max_y)
-    dy_um = -1*(max_y[0] - ny/2) * step_y_um
-    '''
-    plt.figure()
-    plt.subplot(311)
-    plt.plot(ly_ref)
-    plt.subplot(312)
-    plt.plot(ly)
-    plt.subplot(313)
-    plt.plot(corr_1d)
-    plt.show()
-    '''
     print('move y by', dy_um*0.001)
     if moveflag:
         #if np.abs(dy_um)>step_y_um:
@@ -2504,56 +2361,13 @@ def mov_to_image_cen_corr_dsx(scan_id=-1, elem='Pt',bitflag=1, moveflag=1):
 
 def mov_to_image_cen_dsx(scan_id=-1, elem='Ni', bitflag=1, moveflag=1,piezomoveflag=1,x_offset=0,y_offset=0):
 
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    #xrf_Pt = np.asfarray(eval('df2.Det2_' + 'Ni')) + np.asfarray(eval('df2.Det1_' + 'Ni')) + np.asfarray(eval('df2.Det3_' + 'Ni'))
-    hdr = db[scan_id]['start']
-    x_motor = hdr['motor1']
-    y_motor = hdr['motor2']
-    x = np.asarray(df2[x_motor])
-    y = np.asarray(df2[y_motor])
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-    xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    '''
-    xrf_Pt = xrf_Pt/I0
-    index_Pt = np.where(xrf_Pt == np.max(xrf_Pt))
-    Pt_max_y = y[index_Pt]
-    Pt_max_x = x[index_Pt]
-    Pt_max_target_y = -0.5
-    Pt_max_target_x = 0
-    '''
-    #x_offset = 0
-    #y_offset = -2.5
- #   print('move dsy by', Pt_max_target_y-Pt_max_y)
-
- #   movr(smlld.dsy,-1.*(Pt_max_target_y-Pt_max_y)*1.e-3)
-
-
-    #plt.figure()
-    #plt.imshow(xrf)
-
-    if bitflag:
-        xrf[xrf <= 0.2*np.max(xrf)] = 0.
-        xrf[xrf > 0.2*np.max(xrf)] = 1.
-
-    b = ndimage.measurements.center_of_mass(xrf)
-
-    iy = np.int(np.round(b[0]))
-    ix = np.int(np.round(b[1]))
-    i_max = ix + iy * nx
+    xrf_map = load_xrf_map(scan_id, elem)
+    x_motor = xrf_map.x_motor
+    x_cen, y_cen = image_center(xrf_map, elem,
+                                threshold=0.2 if bitflag else None,
+                                bitmask=bool(bitflag))
 
-    x_cen = x[i_max]
-    y_cen = y[i_max]
-
-    print(b,ix,iy,i_max,x_cen,y_cen)
+    print('center', x_cen, y_cen)
     # if moveflag:
         # movr(smlld.dsy,y_cen/1000.)
 
@@ -2601,40 +2415,10 @@ def mov_to_image_cen_dsx(scan_id=-1, elem='Ni', bitflag=1, moveflag=1,piezomovef
 
 def calc_image_cen_smar(scan_id=-1, elem='Er', bitflag=1, movflag=1):
 
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    hdr = db[scan_id]['start']
-    x_motor = hdr['motor1']
-    y_motor = hdr['motor2']
-    x = np.asarray(df2[x_motor])
-    y = np.asarray(df2[y_motor])
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-
-    if bitflag:
-        coe=0.6
-        xrf[xrf <= coe*np.max(xrf)] = 0.
-        xrf[xrf > coe*np.max(xrf)] = 1.
-        xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-
-    else:
-        xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    b = ndimage.measurements.center_of_mass(xrf)
-
-    iy = np.int(np.round(b[0]))
-    ix = np.int(np.round(b[1]))
-    i_max = ix + iy * nx
-
-    x_cen = x[i_max]
-    y_cen = y[i_max]
+    xrf_map = load_xrf_map(scan_id, elem)
+    x_cen, y_cen = image_center(xrf_map, elem,
+                                threshold=0.6 if bitflag else None,
+                                bitmask=bool(bitflag))
 
     cen=[x_cen,y_cen]
     return cen
@@ -2644,44 +2428,11 @@ def calc_image_cen_smar(scan_id=-1, elem='Er', bitflag=1, movflag=1):
 
 def mov_to_image_cen_smar(scan_id=-1, elem='Er', bitflag=1, movflag=1):
 
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    hdr = db[scan_id]['start']
-    x_motor = hdr['motor1']
-    y_motor = hdr['motor2']
-    x = np.asarray(df2[x_motor])
-    y = np.asarray(df2[y_motor])
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-#    xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    #plt.figure()
-    #plt.imshow(xrf)
-
-    if bitflag:
-        coe=0.6
-        xrf[xrf <= coe*np.max(xrf)] = 0.
-        xrf[xrf > coe*np.max(xrf)] = 1.
-        xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-
-    else:
-        xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    b = ndimage.measurements.center_of_mass(xrf)
-
-    iy = np.int(np.round(b[0]))
-    ix = np.int(np.round(b[1]))
-    i_max = ix + iy * nx
-
-    x_cen = x[i_max]
-    y_cen = y[i_max]
+    xrf_map = load_xrf_map(scan_id, elem)
+    x_motor = xrf_map.x_motor
+    x_cen, y_cen = image_center(xrf_map, elem,
+                                threshold=0.6 if bitflag else None,
+                                bitmask=bool(bitflag))
     return (x_cen,y_cen)
 
 
@@ -2781,34 +2532,10 @@ def mov_to_line_center_mll(scan_id=-1,elem='Au',threshold=0,moveflag=1,movepiezo
 
 def mov_to_image_cen_zpss(scan_id=-1, elem='Ni', bitflag=1):
 
-    df2 = db.get_table(db[scan_id],fill=False)
-    xrf = np.asfarray(eval('df2.Det2_' + elem)) + np.asfarray(eval('df2.Det1_' + elem)) + np.asfarray(eval('df2.Det3_' + elem))
-    #x = np.asarray(df2.zpssx)
-    x = np.asarray(df2.zpssz)
-    y = np.asarray(df2.zpssy)
-    I0 = np.asfarray(df2.sclr1_ch4)
-
-    scan_info=db[scan_id]
-    tmp = scan_info['start']
-    nx=tmp['plan_args']['num1']
-    ny=tmp['plan_args']['num2']
-
-    xrf = xrf/I0
-    xrf = np.asarray(np.reshape(xrf,(ny,nx)))
-
-    if bitflag:
-        xrf[xrf <= 0.25*np.max(xrf)] = 0.
-        xrf[xrf > 0.25*np.max(xrf)] = 1.
-
-
-    b = ndimage.measurements.center_of_mass(xrf)
-
-    iy = np.int(np.round(b[0]))
-    ix = np.int(np.round(b[1]))
-    i_max = ix + iy * nx
-
-    x_cen = x[i_max]
-    y_cen = y[i_max]
+    xrf_map = load_xrf_map(scan_id, elem, x_field='zpssz', y_field='zpssy')
+    x_cen, y_cen = image_center(xrf_map, elem,
+                                threshold=0.25 if bitflag else None,
+                                bitmask=bool(bitflag))
     #print('move smarx, smary by', x_cen, y_cen)
     print('move zpssz, zpssy to ',x_cen, y_cen)
 
@@ -3082,43 +2809,23 @@ def stitch_mosaic(start_scan_id, end_scan_id, nx_mosaic, ny_mosaic,elem,norm=Non
     ax1.set_ylabel('smary')
     fig.colorbar(imshow)
 
-def export_merlin(sid,num=1):
+def export_merlin(sid,num=1,mode='copy'):
+    # the frames are copied by default; mode='vds' or 'external' only
+    # link the detector files (see link_frames_h5)
     for i in range(num):
         sid, df = _load_scan(sid, fill_events=False)
-        path = os.path.join('/data/users/2019Q1/Robinson_2019Q1/raw_data/', 'scan_{}.txt'.format(sid))
+        path = table_path('/data/users/2019Q1/Robinson_2019Q1/raw_data/', sid)
         print('Scan {}. Saving to {}'.format(sid, path))
         #non_objects = [name for name, col in df.iteritems() if col.dtype.name not in ('object', )]
         #dump all data
         non_objects = [name for name, col in df.iteritems()]
-        df.to_csv(path, float_format='%1.5e', sep='\t',
-                  columns=sorted(non_objects))
+        write_table(df, path, columns=sorted(non_objects))
 
         path = os.path.join('/data/users/2019Q1/Robinson_2019Q1/raw_data/', 'scan_{}_scaler.txt'.format(sid))
         #np.savetxt(path, (df['sclr1_ch3'], df['p_ssx'], df['p_ssy']), fmt='%1.5e')
         #np.savetxt(path, (df['sclr1_ch4'], df['zpssx'], df['zpssy']), fmt='%1.5e')
-        filename = get_all_filenames(sid,'merlin1')
-        num_subscan = len(filename)
-        if num_subscan == 1:
-            for fn in filename:
-                break
-            path = os.path.join('/data/users/2019Q1/Robinson_2019Q1/raw_data/', 'scan_{}.h5'.format(sid))
-            mycmd = ''.join(['scp', ' ', fn, ' ', path])
-            os.system(mycmd)
-        else:
-            h = db[sid]
-            images = db.get_images(h,name='merlin1')
-            path = os.path.join('/data/users/2019Q1/Robinson_2019Q1/raw_data/', 'scan_{}.h5'.format(sid))
-            f = h5py.File(path, 'w')
-            dset = f.create_dataset('/entry/instrument/detector/data', data=images)
-            f.close()
-            '''''
-            j = 1
-            for fn in filename:
-                path = os.path.join('/home/hyan/export/', 'scan_{}_{}.h5'.format(sid, j))
-                mycmd = ''.join(['scp', ' ', fn, ' ', path])
-                os.system(mycmd)
-                j = j + 1
-            '''''
+        path = os.path.join('/data/users/2019Q1/Robinson_2019Q1/raw_data/', 'scan_{}.h5'.format(sid))
+        export_detector_h5(sid, 'merlin1', path, mode=mode)
         sid = sid + 1
 
 def position_scan(dsx_list,dsy_list,x_range_list,x_num_list,y_range_list,y_num_list,exp_list):
@@ -3389,23 +3096,18 @@ def return_line_center_img_sum(sid,threshold=0.3):
 def plot_img_sum_for_centering(sid, det = 'merlin1', roi_flag=False,x_cen=0,y_cen=0,size=0):
     h = db[sid]
     sid = h.start['scan_id']
-    imgs = list(h.data(det))
-    #imgs = np.array(imgs)
-    imgs = np.array(np.squeeze(imgs))
     df = h.table()
     mon = np.array(df['sclr1_ch4'],dtype=float32)
     #plt.figure()
     #plt.imshow(imgs[0],clim=[0,50])
-    if roi_flag:
-        imgs = imgs[:,x_cen-size//2:x_cen+size//2,y_cen-size//2:y_cen+size//2]
+    roi = (x_cen, y_cen, size) if roi_flag else None
     mots = h.start['motors']
     num_mots = len(mots)
     #num_mots = 1
     #df = h.table()
     x = df[mots[0]]
     x = np.array(x)
-    tot = np.sum(imgs,2)
-    tot = np.array(np.sum(tot,1), dtype=float32)
+    tot = np.array(cached_frame_stats(sid, det, roi)['total'], dtype=float32)
     tot = np.divide(tot,mon)
 
     return {'x':x,'tot':tot}
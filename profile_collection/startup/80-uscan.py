@@ -30,9 +30,7 @@ def theta_fly2d_mll(angle_start,angle_end,num_angle,start1,end1,num1,start2,end2
             yield from bps.sleep(60)
             print('IC3 is lower than 70000, waiting...')
 
-        yield from fly1d(dets1,smlld.dssx,-1,1,100,0.1)
-        a,b = erf_fit(-1,'Au_L')
-        plt.close()
+        a,b = yield from fly1d_fit(dets1,smlld.dssx,-1,1,100,0.1,'Au_L')
         yield from bps.mov(smlld.dssx,a+0.3)
 
         #yield from fly1d(dets1,smlld.dssy,-1,1,100,0.05)
@@ -69,14 +67,10 @@ def theta_fly2d_mll_blank(angle_start,angle_end,num_angle,start1,end1,num1,start
             yield from bps.sleep(60)
             print('IC3 is lower than 70000, waiting...')
 
-        yield from fly1d(dets1,smlld.dssz,9,11,200,0.1)
-        a,b = erf_fit(-1,'Au_L')
-        plt.close()
+        a,b = yield from fly1d_fit(dets1,smlld.dssz,9,11,200,0.1,'Au_L')
         yield from bps.mov(smlld.dssz,a-10)
 
-        yield from fly1d(dets1,smlld.dssy,9,11,200,0.1)
-        a,b = erf_fit(-1,'Au_L')
-        plt.close()
+        a,b = yield from fly1d_fit(dets1,smlld.dssy,9,11,200,0.1,'Au_L')
         yield from bps.mov(smlld.dssy,a-10)
 
 
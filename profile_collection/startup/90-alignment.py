@@ -14,103 +14,60 @@ def erfunc2(z,a,b,c):
     return c*(1.0-scipy.special.erf((z-a)/(b*np.sqrt(2.0))))
 def squarefunc(z,c,a1,b1,a2,b2):
     return c*(scipy.special.erf((z-a1)/(b1*np.sqrt(2.0)))-scipy.special.erf((z-a2)/(b2*np.sqrt(2.0))))
-def erf_fit(sid,elem,mon='sclr1_ch4',linear_flag=True):
+def _edge_profile(sid,elem,mon='sclr1_ch4'):
     h=db[sid]
     sid=h['start']['scan_id']
-    df=h.table()
     mots=h.start['motors']
-    xdata=df[mots[0]]
-    xdata=np.array(xdata,dtype=float)
+    fields=['Det%d_%s' % (chan, elem) for chan in (1, 2, 3)] + [mon, mots[0]]
+    df=h.table(fields=fields,fill=False)
+    xdata=np.array(df[mots[0]],dtype=float)
     ydata=(df['Det1_'+elem]+df['Det2_'+elem]+df['Det3_'+elem])/df[mon]
     ydata=np.array(ydata,dtype=float)
-    y_min=np.min(ydata)
-    y_max=np.max(ydata)
-    ydata=(ydata-y_min)/y_max
+    return sid,mots[0],xdata,ydata
+
+def _plot_edge_fit(xdata,ydata,model,popt):
     plt.figure()
     plt.plot(xdata,ydata,'bo')
-    y_mean = np.mean(ydata)
-    half_size = int (len(ydata)/2)
-    y_half_mean = np.mean(ydata[0:half_size])
-    edge_pos=find_edge(xdata,ydata,10)
-    if y_half_mean < y_mean:
-        if linear_flag == False:
-            popt,pcov=curve_fit(erfunc1,xdata,ydata, p0=[edge_pos,0.05,0.5])
-            fit_data=erfunc1(xdata,popt[0],popt[1],popt[2]);
-        else:
-            popt,pcov=curve_fit(erfunc3,xdata,ydata, p0=[edge_pos,0.05,0.5,0,0])
-            fit_data=erfunc3(xdata,popt[0],popt[1],popt[2],popt[3],popt[4]);
-    else:
-        if linear_flag == False:
-            popt,pcov=curve_fit(erfunc2,xdata,ydata,p0=[edge_pos,0.05,0.5])
-            fit_data=erfunc2(xdata,popt[0],popt[1],popt[2]);
-        else:
-            popt,pcov=curve_fit(erfunc4,xdata,ydata,p0=[edge_pos,0.05,0.5,0,0])
-            fit_data=erfunc4(xdata,popt[0],popt[1],popt[2],popt[3],popt[4]);
-    plt.plot(xdata,fit_data)
-    plt.title('sid= %d edge = %.3f, FWHM = %.2f nm' % (sid,popt[0], popt[1]*2.3548*1000.0))
-    return (popt[0],popt[1]*2.3548*1000.0)
+    fit_data,jac=EDGE_MODELS[model][0](xdata,np.atleast_2d(popt))
+    plt.plot(xdata,fit_data[0])
 
+def erf_fit(sid,elem,mon='sclr1_ch4',linear_flag=True,plot=None):
+    sid,mot,xdata,ydata=_edge_profile(sid,elem,mon)
+    return data_erf_fit(xdata,ydata,linear_flag,plot=plot,sid=sid)
 
 
-def square_fit(sid,elem,mon='sclr1_ch4',linear_flag=True):
 
-    h=db[sid]
-    sid=h['start']['scan_id']
-    df=h.table()
-    mots=h.start['motors']
-    xdata=df[mots[0]]
-    xdata=np.array(xdata,dtype=float)
-    ydata=(df['Det1_'+elem]+df['Det2_'+elem]+df['Det3_'+elem])/df[mon]
-    ydata=np.array(ydata,dtype=float)
-    y_min=np.min(ydata)
-    y_max=np.max(ydata)
-    ydata=(ydata-y_min)/y_max
-    plt.figure()
-    plt.plot(xdata,ydata,'bo')
+def square_fit(sid,elem,mon='sclr1_ch4',linear_flag=True,plot=None):
+    sid,mot,xdata,ydata=_edge_profile(sid,elem,mon)
+    ydata=normalize_profiles(ydata)
     edge_pos_1, edge_pos_2 = find_double_edge(xdata,ydata,10)
-    popt,pcov=curve_fit(squarefunc,xdata,ydata,p0=[0.5,edge_pos_1,0.1,edge_pos_2,0.1])
-    fit_data=squarefunc(xdata,popt[0],popt[1],popt[2],popt[3],popt[4]);
+    popt=fit_edge(xdata,ydata,'squarefunc',[0.5,edge_pos_1,0.1,edge_pos_2,0.1])
 
     #print('a={} b={} c={}'.format(popt[0],popt[1],popt[2]))
-    plt.plot(xdata,fit_data)
-    plt.title('sid= %d cen = %.3f e1 = %.3f e2 = %.3f ' % (sid,(popt[1]+popt[3])*0.5, popt[1],popt[3]))
-    plt.xlabel(mots[0])
+    if _render(plot):
+        _plot_edge_fit(xdata,ydata,'squarefunc',popt)
+        plt.title('sid= %d cen = %.3f e1 = %.3f e2 = %.3f ' % (sid,(popt[1]+popt[3])*0.5, popt[1],popt[3]))
+        plt.xlabel(mot)
     return (popt[1],popt[3],(popt[1]+popt[3])*0.5)
     #return(xdata, ydata, fit_data)
 
 
 
-def data_erf_fit(xdata,ydata,linear_flag=True):
-
+def data_erf_fit(xdata,ydata,linear_flag=True,plot=None,sid=None):
+    '''Edge position and FWHM (nm) of a profile; ydata is normalized
+    to (y - min) / max first'''
     xdata=np.array(xdata,dtype=float)
-    ydata=np.array(ydata,dtype=float)
-    y_min=np.min(ydata)
-    y_max=np.max(ydata)
-    ydata=(ydata-y_min)/y_max
-    plt.figure()
-    plt.plot(xdata,ydata,'bo')
-    y_mean = np.mean(ydata)
-    half_size = int (len(ydata)/2)
-    y_half_mean = np.mean(ydata[0:half_size])
-    edge_pos=find_edge(xdata,ydata,10)
-    if y_half_mean < y_mean:
-        if linear_flag == False:
-            popt,pcov=curve_fit(erfunc1,xdata,ydata, p0=[edge_pos,0.05,0.5])
-            fit_data=erfunc1(xdata,popt[0],popt[1],popt[2]);
-        else:
-            popt,pcov=curve_fit(erfunc3,xdata,ydata, p0=[edge_pos,0.05,0.5,0,0])
-            fit_data=erfunc3(xdata,popt[0],popt[1],popt[2],popt[3],popt[4]);
-    else:
-        if linear_flag == False:
-            popt,pcov=curve_fit(erfunc2,xdata,ydata,p0=[edge_pos,0.05,0.5])
-            fit_data=erfunc2(xdata,popt[0],popt[1],popt[2]);
-        else:
-            popt,pcov=curve_fit(erfunc4,xdata,ydata,p0=[edge_pos,0.05,0.5,0,0])
-            fit_data=erfunc4(xdata,popt[0],popt[1],popt[2],popt[3],popt[4]);
+    ydata=normalize_profiles(np.array(ydata,dtype=float))
+    params,models=fit_erf_edges(xdata,ydata,linear_flag)
+    popt=params[0]
 
     #print('a={} b={} c={}'.format(popt[0],popt[1],popt[2]))
-    plt.plot(xdata,fit_data)
-    plt.title('sid= %d edge = %.3f, FWHM = %.2f nm' % (sid,popt[0], popt[1]*2.3548*1000.0))
+    if _render(plot):
+        _plot_edge_fit(xdata,ydata,models[0],popt)
+        if sid is None:
+            plt.title('edge = %.3f, FWHM = %.2f nm' % (popt[0], popt[1]*2.3548*1000.0))
+        else:
+            plt.title('sid= %d edge = %.3f, FWHM = %.2f nm' % (sid,popt[0], popt[1]*2.3548*1000.0))
     return (popt[0],popt[1]*2.3548*1000.0)
 
 
@@ -123,7 +80,7 @@ def mll_z_alignment(z_start, z_end, z_num, mot, start, end, num, acq_time, elem=
     yield from bps.movr(smlld.sbz, z_start)
     for i in range(z_num + 1):
 
-        yield from fly1d(dets1, mot, start, end, num, acq_time)
+        edge_pos,fwhm=yield from fly1d_fit(dets1, mot, start, end, num, acq_time, elem, mon=mon, plot=None)
 
         #plot(-1, elem, mon)
         #plt.title('sbz = %.3f' % smlld.sbz.position)
@@ -156,7 +113,6 @@ def mll_z_alignment(z_start, z_end, z_num, mot, start, end, num, acq_time, elem=
         fit_size[i]=popt[1]*2.3548*1000
         plt.title('sid = %d sbz = %.3f um FWHM = %.2f nm' %(sid,smlld.sbz.position,fit_size[i]))
         '''
-        edge_pos,fwhm=erf_fit(-1,elem,mon)
         fit_size[i]= fwhm
         z_pos[i]=smlld.sbz.position
         yield from bps.movr(smlld.sbz, z_step)
@@ -166,20 +122,11 @@ def mll_z_alignment(z_start, z_end, z_num, mot, start, end, num, acq_time, elem=
     plt.xlabel('sbz')
 
 def find_edge(xdata,ydata,size):
-    set_point=0.5
-    j=int (ceil(size/2.0))
-    l=len(ydata)
-    local_mean=np.zeros(l-size)
-    for i in range(l-size):
-        local_mean[i]=np.mean(ydata[i:i+size])
-    zdata=abs(local_mean-np.array(set_point))
-    index=scipy.argmin(zdata)
-    index=index+j
-    return xdata[index]
+    return find_edges(xdata,ydata,size)
 
 def find_double_edge(xdata, ydata, size):
     edge_1 = find_edge(xdata, ydata, size)
-    index = scipy.argmax(ydata)
+    index = np.argmax(ydata)
     cen = xdata[index]
     if cen > edge_1:
         edge_2 = (cen-edge_1) + cen
@@ -194,8 +141,7 @@ def hmll_z_alignment(z_start, z_end, z_num, start, end, num, acq_time, elem='Pt_
     init_hz = hmll.hz.position
     yield from bps.movr(hmll.hz, z_start)
     for i in range(z_num + 1):
-        yield from fly1d(dets1,dssx, start, end, num, acq_time)
-        edge_pos,fwhm=erf_fit(-1,elem,mon)
+        edge_pos,fwhm=yield from fly1d_fit(dets1,dssx, start, end, num, acq_time, elem, mon=mon, plot=None)
         fit_size[i]=fwhm
         z_pos[i]=hmll.hz.position
         yield from bps.movr(hmll.hz, z_step)
@@ -211,8 +157,7 @@ def mll_vchi_alignment(vchi_start, vchi_end, vchi_num, mot, start, end, num, acq
     init_vchi = vmll.vchi.position
     yield from bps.movr(vmll.vchi, vchi_start)
     for i in range(vchi_num + 1):
-        yield from fly1d(dets1, mot, start, end, num, acq_time)
-        edge_pos,fwhm=erf_fit(-1,elem,mon)
+        edge_pos,fwhm=yield from fly1d_fit(dets1, mot, start, end, num, acq_time, elem, mon=mon, plot=None)
         fit_size[i]=fwhm
         vchi_pos[i]=vmll.vchi.position
         yield from bps.movr(vmll.vchi, vchi_step)
@@ -228,8 +173,7 @@ def vmll_z_alignment(z_start, z_end, z_num, start, end, num, acq_time, elem='Pt_
     init_vz = vmll.vz.position
     yield from bps.movr(vmll.vz, z_start)
     for i in range(z_num + 1):
-        yield from fly1d(dets1,dssy, start, end, num, acq_time)
-        edge_pos,fwhm=erf_fit(-1,elem,mon)
+        edge_pos,fwhm=yield from fly1d_fit(dets1,dssy, start, end, num, acq_time, elem, mon=mon, plot=None)
         #plt.title('vz={}'.format(vmll.vz.position),loc='right')
         fit_size[i]=fwhm
         z_pos[i]=vmll.vz.position
@@ -249,8 +193,7 @@ def zp_z_alignment(z_start, z_end, z_num, mot, start, end, num, acq_time, elem='
     yield from movr_zpz1(z_start)
     for i in range(z_num + 1):
 
-        yield from fly1d(dets1, mot, start, end, num, acq_time)
-        edge_pos,fwhm=erf_fit(-1,elem,mon,linear_flag=False)
+        edge_pos,fwhm=yield from fly1d_fit(dets1, mot, start, end, num, acq_time, elem, mon=mon, linear_flag=False, plot=None)
         fit_size[i]= fwhm
         z_pos[i]=zp.zpz1.position
         yield from movr_zpz1(z_step)
@@ -340,14 +283,12 @@ def zp_rot_alignment_edge(a_start, a_end, a_num, start, end, num, acq_time, elem
         x[i] = a_start + i*a_step
         yield from bps.mov(zps.zpsth, x[i])
         if np.abs(x[i]) > 45:
-            yield from fly1d(dets1,zpssz,start,end,num,acq_time)
             #tmp = return_line_center(-1, elem=elem,threshold=0.5)
-            edge,fwhm = erf_fit(-1,elem = elem,linear_flag=False)
+            edge,fwhm = yield from fly1d_fit(dets1,zpssz,start,end,num,acq_time,elem,linear_flag=False,plot=None)
             y[i] = edge*np.sin(x[i]*np.pi/180.0)
         else:
-            yield from fly1d(dets1,zpssx,start,end,num,acq_time)
             #tmp = return_line_center(-1,elem=elem,threshold=0.5)
-            edge,fwhm = erf_fit(-1,elem = elem,linear_flag=False)
+            edge,fwhm = yield from fly1d_fit(dets1,zpssx,start,end,num,acq_time,elem,linear_flag=False,plot=None)
             y[i] = edge*np.cos(x[i]*np.pi/180.0)
         print('y=',y[i])
     y = -1*np.array(y)
@@ -375,13 +316,11 @@ def zp_rot_alignment(a_start, a_end, a_num, start, end, num, acq_time, elem='Pt_
         x[i] = a_start + i*a_step
         yield from bps.mov(zps.zpsth, x[i])
         if np.abs(x[i]) > 45:
-            yield from fly1d(dets1,zpssz,start,end,num,acq_time)
-            tmp = return_line_center(-1, elem=elem,threshold=0.5)
+            tmp = yield from fly1d_fit(dets1,zpssz,start,end,num,acq_time,elem,'center',mon=None,threshold=0.5)
             #edge,fwhm = erf_fit(-1,elem = elem)
             y[i] = tmp*np.sin(x[i]*np.pi/180.0)
         else:
-            yield from fly1d(dets1,zpssx,start,end,num,acq_time)
-            tmp = return_line_center(-1,elem=elem,threshold=0.5)
+            tmp = yield from fly1d_fit(dets1,zpssx,start,end,num,acq_time,elem,'center',mon=None,threshold=0.5)
             #edge,fwhm = erf_fit(-1,elem = elem)
             y[i] = tmp*np.cos(x[i]*np.pi/180.0)
         print('y=',y[i])
@@ -412,20 +351,16 @@ def mll_rot_alignment(a_start, a_end, a_num, start, end, num, acq_time, elem='Pt
         x[i] = a_start + i*a_step
         yield from bps.mov(smlld.dsth, x[i])
         if np.abs(x[i]) > 45:
-            yield from fly1d(dets1,dssz,start,end,num,acq_time)
-            tmp = return_line_center(-1, elem=elem)
+            tmp = yield from fly1d_fit(dets1,dssz,start,end,num,acq_time,elem,'center',mon=None)
             y[i] = tmp*np.sin(x[i]*np.pi/180.0)
         else:
-            yield from fly1d(dets1,dssx,start,end,num,acq_time)
-            tmp = return_line_center(-1,elem=elem)
+            tmp = yield from fly1d_fit(dets1,dssx,start,end,num,acq_time,elem,'center',mon=None)
             y[i] = -tmp*np.cos(x[i]*np.pi/180.0)
         #yield from fly1d(dets1,dssy,start,end,num,acq_time)
         #tmp = return_line_center(-1, elem=elem)
         #v[i] = tmp
         #print('h_cen= ',y[i],'v_cen = ',v[i])
-        plot(-1,elem,'sclr1_ch4')
         #insertFig(note='dsth = {}'.format(check_baseline(-1,'dsth')))
-        plt.close()
 
     y = -1*np.array(y)
     x = np.array(x)
@@ -460,8 +395,7 @@ def mll_rot_v_alignment(a_start, a_end, a_num, start, end, num, acq_time, elem='
     for i in range(a_num+1):
         x[i] = a_start + i*a_step
         yield from bps.mov(smlld.dsth, x[i])
-        yield from fly1d(dets1,dssy,start,end,num,acq_time)
-        edge_pos,fwhm=erf_fit(-1,elem=elem,mon=mon)
+        edge_pos,fwhm=yield from fly1d_fit(dets1,dssy,start,end,num,acq_time,elem,mon=mon,plot=None)
         y[i] = edge_pos
     y = -1*np.array(y)
     x = np.array(x)
@@ -0,0 +1,232 @@
+import bluesky.plan_stubs as bps
+import numpy as np
+
+
+class RotationFit:
+    '''Least-squares fit of a position measured at several rotation angles
+
+    The sample feature seen at angle theta (degrees) follows
+    y = r0 + dr * sin(theta + offset) = r0 + a * sin(theta) + b * cos(theta),
+    as in rot_fit_2, which is linear in (r0, a, b). The fit is updated
+    in closed form after every point. The correction of the rotation axis
+    is dx = -b, dz = -a (times `scale`), as in the *_rot_alignment plans.
+
+    Parameters
+    ----------
+    scale : float, optional
+        Units of dx and dz per unit of y, e.g. 1e-3 for nm to um
+    sigma : float, optional
+        Noise of a measurement, used for the uncertainties until there
+        are enough points to estimate it from the residuals
+    '''
+    def __init__(self, scale=1.0, sigma=None):
+        self.scale = scale
+        self.sigma = sigma
+        self.angles = []
+        self.values = []
+
+    @staticmethod
+    def design(angles):
+        theta = np.deg2rad(np.atleast_1d(np.asarray(angles, dtype=float)))
+        return np.column_stack([np.ones_like(theta), np.sin(theta),
+                                np.cos(theta)])
+
+    def add(self, angle, value):
+        self.angles.append(float(angle))
+        self.values.append(float(value))
+
+    def __len__(self):
+        return len(self.angles)
+
+    @property
+    def params(self):
+        '''(r0, a, b), or None with fewer than 3 points'''
+        if len(self) < 3:
+            return None
+        return np.linalg.lstsq(self.design(self.angles),
+                               np.asarray(self.values), rcond=None)[0]
+
+    @property
+    def rot_params(self):
+        '''(r0, dr, offset in degrees), as returned by rot_fit_2'''
+        r0, a, b = self.params
+        return r0, np.hypot(a, b), np.rad2deg(np.arctan2(b, a))
+
+    def noise(self):
+        '''Measurement noise: residual estimate, or the prior sigma'''
+        n = len(self)
+        if n <= 3:
+            return self.sigma
+        res = np.asarray(self.values) - self.design(self.angles) @ self.params
+        if self.sigma is None:
+            return np.sqrt(res @ res / (n - 3))
+        # the prior counts as one more degree of freedom
+        return np.sqrt((self.sigma ** 2 + res @ res) / (n - 2))
+
+    def correction(self):
+        '''(dx, dz, std_dx, std_dz); the std are NaN when unknown'''
+        r0, a, b = self.params
+        noise = self.noise()
+        if noise is None:
+            std = (np.nan, np.nan)
+        else:
+            cov = noise ** 2 * np.linalg.pinv(
+                self.design(self.angles).T @ self.design(self.angles))
+            std = (self.scale * np.sqrt(cov[2, 2]),
+                   self.scale * np.sqrt(cov[1, 1]))
+        return -b * self.scale, -a * self.scale, std[0], std[1]
+
+    def next_angle(self, candidates, min_separation=0.):
+        '''The candidate angle that best reduces the parameter uncertainty
+
+        D-optimal choice: adding angle t multiplies det(X^T X) by
+        1 + f(t)^T (X^T X)^-1 f(t), so the angle with the largest
+        prediction variance is measured next. Candidates closer than
+        `min_separation` to a measured angle are skipped.
+        '''
+        candidates = np.asarray(candidates, dtype=float)
+        if self.angles:
+            distance = np.min(np.abs(candidates[:, None] -
+                                     np.asarray(self.angles)[None, :]),
+                              axis=1)
+            candidates = candidates[distance > min_separation]
+        if not len(candidates):
+            return None
+        x = self.design(self.angles) if self.angles else np.zeros((0, 3))
+        info = np.linalg.pinv(x.T @ x + 1e-9 * np.eye(3))
+        f = self.design(candidates)
+        gain = np.einsum('ij,jk,ik->i', f, info, f)
+        return candidates[np.argmax(gain)]
+
+
+def adaptive_rot_alignment(measure, rot_motor, a_start, a_end, *,
+                           tol=0.01, max_points=12, min_points=5,
+                           candidates=37, scale=1.0, sigma=None,
+                           return_to=None):
+    '''Rotation axis alignment that stops as soon as dx and dz converge
+
+    Instead of a fixed list of angles, the sinusoid is refitted after
+    every line scan and the next angle is the one that reduces the
+    uncertainty of the fit the most (see RotationFit.next_angle).
+
+    Parameters
+    ----------
+    measure : callable
+        measure(angle) is a plan that scans the sample at the current
+        angle and returns the projected position y (see RotationFit)
+    rot_motor : positioner
+    a_start, a_end : float
+        Range of angles to choose from, in degrees
+    tol : float, optional
+        Stop when the standard errors of dx and dz and their change since
+        the last point are all below tol (in units of dx)
+    max_points, min_points : int, optional
+    candidates : int, optional
+        Number of angles of the grid over [a_start, a_end]
+    scale : float, optional
+        Units of dx and dz per unit of y
+    sigma : float, optional
+        Prior noise of a measurement, in units of y
+    return_to : float, optional
+        Angle to go back to at the end; by default the starting angle
+
+    Returns
+    -------
+    dx, dz : float
+    fit : RotationFit
+    '''
+    if return_to is None:
+        return_to = rot_motor.position
+    grid = np.linspace(a_start, a_end, candidates)
+    separation = 0.5 * abs(a_end - a_start) / max(candidates - 1, 1)
+    fit = RotationFit(scale, sigma)
+    previous = None
+    dx = dz = np.nan
+
+    for angle in (a_start, a_end, 0.5 * (a_start + a_end)):
+        yield from bps.mov(rot_motor, angle)
+        fit.add(angle, (yield from measure(angle)))
+
+    while True:
+        dx, dz, std_dx, std_dz = fit.correction()
+        print('\t{} angles: dx = {:.4f} +/- {:.4f}, dz = {:.4f} +/- {:.4f}'
+              ''.format(len(fit), dx, std_dx, dz, std_dz))
+        if len(fit) >= min_points and previous is not None and \
+                max(std_dx, std_dz) < tol and \
+                max(abs(dx - previous[0]), abs(dz - previous[1])) < tol:
+            print('\tConverged after {} angles'.format(len(fit)))
+            break
+        if len(fit) >= max_points:
+            print('\tNot converged after {} angles'.format(len(fit)))
+            break
+        angle = fit.next_angle(grid, separation)
+        if angle is None:
+            break
+        previous = (dx, dz)
+        yield from bps.mov(rot_motor, angle)
+        fit.add(angle, (yield from measure(angle)))
+
+    yield from bps.mov(rot_motor, return_to)
+    return dx, dz, fit
+
+
+def _line_position(dets, motor, start, end, num, acq_time, elem, method):
+    '''Plan: line scan and the position of its edge or line center'''
+    if method == 'edge':
+        edge, fwhm = yield from fly1d_fit(dets, motor, start, end, num,
+                                          acq_time, elem, 'edge',
+                                          linear_flag=False)
+        return edge
+    return (yield from fly1d_fit(dets, motor, start, end, num, acq_time,
+                                 elem, 'center', mon=None, threshold=0.5))
+
+
+def zp_rot_alignment_adaptive(a_start, a_end, start, end, num, acq_time,
+                              elem='Pt_L', method='edge', move_flag=0,
+                              tol=0.01, max_points=12):
+    '''Adaptive version of zp_rot_alignment(_edge); see
+    adaptive_rot_alignment. method is 'edge' or 'center'.'''
+    def measure(angle):
+        if np.abs(angle) > 45:
+            pos = yield from _line_position(dets1, zpssz, start, end, num,
+                                            acq_time, elem, method)
+            y = pos * np.sin(np.deg2rad(angle))
+        else:
+            pos = yield from _line_position(dets1, zpssx, start, end, num,
+                                            acq_time, elem, method)
+            y = pos * np.cos(np.deg2rad(angle))
+        return -y
+
+    dx, dz, fit = yield from adaptive_rot_alignment(
+        measure, zps.zpsth, a_start, a_end, tol=tol, max_points=max_points,
+        scale=1e-3)
+    print('dx=', dx, '   ', 'dz=', dz)
+    if move_flag:
+        yield from bps.movr(zps.smarx, dx)
+        yield from bps.movr(zps.smarz, dz)
+    return fit.angles, fit.values
+
+
+def mll_rot_alignment_adaptive(a_start, a_end, start, end, num, acq_time,
+                               elem='Pt_L', move_flag=0, tol=0.01,
+                               max_points=12):
+    '''Adaptive version of mll_rot_alignment; see adaptive_rot_alignment'''
+    def measure(angle):
+        if np.abs(angle) > 45:
+            pos = yield from fly1d_fit(dets1, dssz, start, end, num,
+                                       acq_time, elem, 'center', mon=None)
+            y = pos * np.sin(np.deg2rad(angle))
+        else:
+            pos = yield from fly1d_fit(dets1, dssx, start, end, num,
+                                       acq_time, elem, 'center', mon=None)
+            y = -pos * np.cos(np.deg2rad(angle))
+        return -y
+
+    dx, dz, fit = yield from adaptive_rot_alignment(
+        measure, smlld.dsth, a_start, a_end, tol=tol, max_points=max_points,
+        return_to=0)
+    print('dx=', dx, '   ', 'dz=', dz)
+    if move_flag:
+        yield from bps.movr(smlld.dsx, dx)
+        yield from bps.movr(smlld.dsz, dz)
+    return fit.angles, fit.values
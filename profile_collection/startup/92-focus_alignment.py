@@ -0,0 +1,195 @@
+import math
+
+import bluesky.plan_stubs as bps
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def _brent_minimize(a, b, xtol, max_evals):
+    '''Brent's minimization of f on [a, b], written as a coroutine
+
+    Yields the next x to evaluate and expects f(x) to be sent back;
+    returns (x, f(x)) of the best point once the minimum is bracketed
+    to within xtol, or after max_evals evaluations. Parabolic steps are
+    used while they behave, golden section steps otherwise.
+    '''
+    golden = 0.5 * (3.0 - math.sqrt(5.0))
+    a, b = min(a, b), max(a, b)
+    tol = xtol / 4.0
+    x = w = v = a + golden * (b - a)
+    fx = fw = fv = yield x
+    d = e = 0.0
+    for evals in range(1, max_evals):
+        m = 0.5 * (a + b)
+        if abs(x - m) <= 2 * tol - 0.5 * (b - a):
+            break
+        if abs(e) > tol:
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = 2.0 * (q - r)
+            if q > 0:
+                p = -p
+            q = abs(q)
+            e_prev, e = e, d
+            if abs(p) >= abs(0.5 * q * e_prev) or p <= q * (a - x) or \
+                    p >= q * (b - x):
+                e = (a - x) if x >= m else (b - x)
+                d = golden * e
+            else:
+                d = p / q
+                u = x + d
+                if u - a < 2 * tol or b - u < 2 * tol:
+                    d = math.copysign(tol, m - x)
+        else:
+            e = (a - x) if x >= m else (b - x)
+            d = golden * e
+        u = x + (d if abs(d) >= tol else math.copysign(tol, d))
+        fu = yield u
+        if fu <= fx:
+            if u >= x:
+                a = x
+            else:
+                b = x
+            v, w, x = w, x, u
+            fv, fw, fx = fw, fx, fu
+        else:
+            if u < x:
+                a = u
+            else:
+                b = u
+            if fu <= fw or w == x:
+                v, w = w, u
+                fv, fw = fw, fu
+            elif fu <= fv or v == x or v == w:
+                v, fv = u, fu
+    return x, fx
+
+
+def focus_scan(z_motor, z_start, z_end, measure, *, ztol=0.5, max_scans=10,
+               move=None, move_to_best=False):
+    '''Find the focus by minimizing a measured beam size over z
+
+    Replaces the fixed z grid of the *_z_alignment plans with Brent's
+    method, so z is only sampled where the minimum can be.
+
+    Parameters
+    ----------
+    z_motor : positioner
+    z_start, z_end : float
+        Search range, relative to the current position
+    measure : callable
+        measure() is a plan that scans at the current z and returns the
+        beam size (e.g. the FWHM of an edge fit); it raises LiveFitError
+        when the size could not be fitted
+    ztol : float, optional
+        Stop when the minimum is bracketed to within ztol
+    max_scans : int, optional
+    move : callable, optional
+        move(z) is a plan moving to absolute z; defaults to bps.mov
+    move_to_best : bool, optional
+        End at the best z instead of the initial one
+
+    Returns
+    -------
+    z_best, size_best : float
+    history : list of (z, size)
+    '''
+    if move is None:
+        def move(z):
+            yield from bps.mov(z_motor, z)
+
+    z_init = z_motor.position
+    search = _brent_minimize(z_init + z_start, z_init + z_end, ztol,
+                             max_scans)
+    history = []
+    z = next(search)
+    while True:
+        yield from move(z)
+        try:
+            size = abs(float((yield from measure())))
+        except LiveFitError as ex:
+            # only the fit; errors of the scan itself (aborts, failed
+            # motors or detectors) end the plan
+            print('\tz = {:.4f}: fit failed ({!r})'.format(z, ex))
+            size = np.nan
+        if not np.isfinite(size):
+            # treat a failed fit as worse than everything seen so far
+            finite = [s for zz, s in history if np.isfinite(s)]
+            size = 2 * max(finite) if finite else 1e12
+        history.append((z, size))
+        print('\tz = {:.4f}: size = {:.2f}'.format(z, size))
+        try:
+            z = search.send(size)
+        except StopIteration as stop:
+            z_best, size_best = stop.value
+            break
+
+    print('Focus: z = {:.4f}, size = {:.2f} after {} scans'.format(
+        z_best, size_best, len(history)))
+    yield from move(z_best if move_to_best else z_init)
+
+    if _render(None):
+        z_pos, fit_size = np.array(history).T
+        plt.figure()
+        plt.plot(z_pos, fit_size, 'bo')
+        plt.axvline(z_best)
+        plt.xlabel(z_motor.name)
+    return z_best, size_best, history
+
+
+def _edge_fwhm(mot, start, end, num, acq_time, elem, mon, linear_flag=True):
+    '''Plan: line scan and FWHM of the edge, fitted live and headlessly'''
+    def measure():
+        edge_pos, fwhm = yield from fly1d_fit(
+            dets1, mot, start, end, num, acq_time, elem, 'edge', mon=mon,
+            linear_flag=linear_flag)
+        return fwhm
+    return measure
+
+
+def mll_z_focus(z_start, z_end, mot, start, end, num, acq_time, elem='Pt_L',
+                mon='sclr1_ch4', ztol=0.5, max_scans=10, move_to_best=False):
+    '''Optimizing version of mll_z_alignment; see focus_scan'''
+    return (yield from focus_scan(
+        smlld.sbz, z_start, z_end,
+        _edge_fwhm(mot, start, end, num, acq_time, elem, mon),
+        ztol=ztol, max_scans=max_scans, move_to_best=move_to_best))
+
+
+def hmll_z_focus(z_start, z_end, start, end, num, acq_time, elem='Pt_L',
+                 mon='sclr1_ch4', ztol=0.5, max_scans=10, move_to_best=False):
+    '''Optimizing version of hmll_z_alignment; see focus_scan'''
+    return (yield from focus_scan(
+        hmll.hz, z_start, z_end,
+        _edge_fwhm(dssx, start, end, num, acq_time, elem, mon),
+        ztol=ztol, max_scans=max_scans, move_to_best=move_to_best))
+
+
+def vmll_z_focus(z_start, z_end, start, end, num, acq_time, elem='Pt_L',
+                 mon='sclr1_ch4', ztol=0.5, max_scans=10, move_to_best=False):
+    '''Optimizing version of vmll_z_alignment; see focus_scan'''
+    return (yield from focus_scan(
+        vmll.vz, z_start, z_end,
+        _edge_fwhm(dssy, start, end, num, acq_time, elem, mon),
+        ztol=ztol, max_scans=max_scans, move_to_best=move_to_best))
+
+
+def zp_z_focus(z_start, z_end, mot, start, end, num, acq_time, elem=' ',
+               mon='sclr1_ch4', ztol=0.5, max_scans=10, move_to_best=False):
+    '''Optimizing version of zp_z_alignment; see focus_scan
+
+    zpz1 is moved with mov_zpz1, which also corrects zpx and zpy.
+    '''
+    edge_fwhm = _edge_fwhm(mot, start, end, num, acq_time, elem, mon,
+                           linear_flag=False)
+
+    def measure():
+        fwhm = yield from edge_fwhm()
+        merlin1.unstage()
+        xspress3.unstage()
+        return fwhm
+
+    return (yield from focus_scan(
+        zp.zpz1, z_start, z_end, measure, ztol=ztol, max_scans=max_scans,
+        move=mov_zpz1, move_to_best=move_to_best))
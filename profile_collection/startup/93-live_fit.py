@@ -0,0 +1,148 @@
+import bluesky.preprocessors as bpp
+import numpy as np
+from bluesky.callbacks.core import CallbackBase
+
+
+class LiveFitError(RuntimeError):
+    '''A scan finished without a result from its live fit'''
+
+
+class LiveLineFit(CallbackBase):
+    '''Build a line scan profile from live documents and fit it at the end
+
+    The profile (sum of the ROI channels of `elem`, optionally divided by
+    a monitor) is accumulated from the events as they arrive; the fit is
+    done when the stop document is received, so a plan can use the result
+    right after the scan without reading it back from the database.
+
+    Parameters
+    ----------
+    elem : str
+        Element or ROI column
+    kind : {'edge', 'center', 'peak'}, optional
+        'edge' fits an erf edge as erf_fit does, giving (edge, FWHM in nm);
+        'center' is the thresholded center of mass, as return_line_center
+        (which uses mon=None); 'peak' is the position of the maximum
+    mon : str, optional
+        Monitor the profile is divided by
+    motor : str, optional
+        Data key of the positions; by default the first scanned motor
+    channels : sequence of int, optional
+    linear_flag : bool, optional
+        Fit a linear background with 'edge'
+    threshold : float, optional
+        Relative threshold of 'center'
+    plot : bool or None, optional
+        Plot the 'edge' fit, as erf_fit does (None: unless headless)
+
+    Attributes
+    ----------
+    result : float, tuple or None
+        Result of the last scan, None until its stop document
+    x, y : ndarray
+        Profile of the last scan
+    '''
+    def __init__(self, elem, kind='edge', mon='sclr1_ch4', motor=None,
+                 channels=(1, 2, 3), linear_flag=True, threshold=0.2,
+                 plot=False):
+        super().__init__()
+        if kind not in ('edge', 'center', 'peak'):
+            raise ValueError('Unknown fit kind: {!r}'.format(kind))
+        self.elem = elem
+        self.kind = kind
+        self.mon = mon
+        self.motor = motor
+        self.channels = channels
+        self.linear_flag = linear_flag
+        self.threshold = threshold
+        self.plot = plot
+        self.result = None
+        self.scan_id = None
+        self.x = self.y = np.zeros(0)
+
+    def start(self, doc):
+        self.result = None
+        self.scan_id = doc.get('scan_id')
+        self._motor = self.motor
+        if self._motor is None:
+            motors = doc.get('motors') or [doc.get('motor')]
+            self._motor = motors[0]
+        self._keys = None
+        self._use_mon = self.mon
+        self._x = []
+        self._y = []
+        self._mon = []
+
+    def descriptor(self, doc):
+        keys = doc['data_keys']
+        if self._keys is not None or self._motor not in keys:
+            return
+        if self.elem in keys:
+            self._keys = [self.elem]
+        else:
+            self._keys = ['Det%d_%s' % (chan, self.elem)
+                          for chan in self.channels]
+            if not all(key in keys for key in self._keys):
+                self._keys = None
+                return
+        if self.mon is not None and self.mon not in keys:
+            print('\tLive fit: no monitor {} in scan {}; fitting {} without '
+                  'it'.format(self.mon, self.scan_id, self.elem))
+            self._use_mon = None
+
+    def event_page(self, doc):
+        data = doc['data']
+        if self._keys is None or self._keys[0] not in data or \
+                self._motor not in data:
+            return
+        self._x.append(np.asarray(data[self._motor], dtype=np.float64))
+        self._y.append(np.sum([np.asarray(data[key], dtype=np.float64)
+                               for key in self._keys], axis=0))
+        if self._use_mon is not None:
+            self._mon.append(np.asarray(data[self._use_mon],
+                                        dtype=np.float64))
+
+    def event(self, doc):
+        self.event_page({'data': {key: [value] for key, value
+                                  in doc['data'].items()}})
+
+    def stop(self, doc):
+        if not self._x:
+            print('\tLive fit: no {} data in scan {}'.format(
+                self.elem, self.scan_id))
+            return
+        self.x = np.concatenate(self._x)
+        self.y = np.concatenate(self._y)
+        if self._use_mon is not None:
+            self.y = self.y / np.concatenate(self._mon)
+        try:
+            self.result = self.fit(self.x, self.y)
+        except Exception as ex:
+            print('\tLive fit of scan {} failed: {!r}'.format(
+                self.scan_id, ex))
+
+    def fit(self, x, y):
+        if self.kind == 'edge':
+            return data_erf_fit(x, y, self.linear_flag, plot=self.plot,
+                                sid=self.scan_id)
+        elif self.kind == 'center':
+            return com_1d(y, x, threshold=self.threshold)
+        return x[np.argmax(y)]
+
+
+def fly1d_fit(dets, motor, start, end, num, acq_time, elem, kind='edge',
+              **kwargs):
+    '''fly1d, returning the live fit of the line (see LiveLineFit)
+
+    E.g. in a plan:
+
+        edge, fwhm = yield from fly1d_fit(dets1, dssx, -1, 1, 100, 0.1,
+                                          'Pt_L')
+    '''
+    fit = LiveLineFit(elem, kind, **kwargs)
+    yield from bpp.subs_wrapper(
+        fly1d(dets, motor, start, end, num, acq_time), fit)
+    if fit.result is None:
+        raise LiveFitError('No fit result for the {} scan of {}'.format(
+            elem, getattr(motor, 'name', motor)))
+    return fit.result